@@ -1,12 +1,64 @@
+import argparse
 import sys
-from .utils import verbose, ERROR
+from .profiling import Profiler
+from .programs import p3, p3b, p3e, p7
 
 
 def main(args):
-    if len(args) != 2:
-        verbose("%s PATH" % args[0], ERROR)
-        return 1
-    p3b(args[1])
+    parser = argparse.ArgumentParser(prog=args[0])
+    parser.add_argument('path')
+    parser.add_argument('--time-budget', type=float,
+                        help='Do not start merging new files after this many seconds')
+    parser.add_argument('--io-budget', type=int,
+                        help='Do not read more then this many bytes to hash files')
+    parser.add_argument('--estimate', action='store_true',
+                        help='Only estimate the bytes a merge would reclaim')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='Save the timers of the hot paths in REPORT')
+    parser.add_argument('--profile-allocations', action='store_true',
+                        help='Trace the peak of the allocated memory for the report (slow)')
+    parser.add_argument('--profile-stats', metavar='PSTATS',
+                        help='Save a cProfile profile in PSTATS (slow)')
+    parser.add_argument('--scan', action='store_true',
+                        help='Only scan the snapshots, that are not scanned yet')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Scan this many snapshots at the same time')
+    parser.add_argument('--walks-per-device', type=int, default=1,
+                        help='Scan only this many snapshots on the same device at the same time')
+    parser.add_argument('--rescan', action='store_true',
+                        help='Scan the snapshots again and skip unchanged directories')
+    parser.add_argument('--memory-budget', type=int,
+                        help='Scan each snapshot within this many bytes of memory, '
+                             'the records are spilled to temporary files')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Scan and merge PATH at once, hash files while the '
+                             'walk is still running (needs Python 3.7)')
+    parser.add_argument('--hashers', type=int, default=4,
+                        help='Hash this many files at the same time with --pipeline')
+    options = parser.parse_args(args[1:])
+    if options.memory_budget is not None and options.rescan:
+        parser.error('--memory-budget can not be used with --rescan')
+    profiler = None
+    if options.profile or options.profile_stats:
+        profiler = Profiler(allocations=options.profile_allocations,
+                            cprofile=options.profile_stats is not None)
+        profiler.enable()
+    if options.scan or options.rescan:
+        p3(options.path, options.processes, options.walks_per_device,
+           options.rescan, options.memory_budget)
+    elif options.estimate:
+        p3e(options.path)
+    elif options.pipeline:
+        p7(options.path, options.hashers)
+    else:
+        p3b(options.path, options.time_budget, options.io_budget)
+    if profiler is not None:
+        profiler.disable()
+        if options.profile:
+            profiler.dump_report(options.profile)
+        if options.profile_stats:
+            profiler.dump_stats(options.profile_stats)
 
 
-main(sys.argv)
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,137 @@
+import os
+import stat
+
+from .inode import INodeFile
+from .utils import verbose, INFO, DEBUG
+
+
+class DirectoryCache(object):
+    """
+    A persistent cache of directories and the inodes of their files.
+
+    For each directory the mtime, the ctime, the names of the subdirectories
+    and the name, inode and size of each regular file are saved. When a
+    directory is walked again and its mtime and ctime did not change, its
+    entries are taken from the cache. So only one lstat is needed for an
+    unchanged directory instead of listing it and an lstat for each file.
+
+    Files that are changed in place do not change the mtime of their
+    directory, so the cache is meant for archives, where files are not
+    modified.
+
+    Attributes
+    ----------
+    path: the file where the cache is saved
+    directories: a dict that maps the path of a directory to its mtime, ctime,
+                 a list of subdirectory names and a list of (name, inode,
+                 size) tuples
+    """
+    def __init__(self, path=None):
+        """
+        'path' is the file where the cache is saved. If it exists, the cache
+        is loaded from it.
+        """
+        self.path = path
+        self.directories = {}
+        self.reused = 0
+        self.listed = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self.directories)
+
+    def __repr__(self):
+        return "cache with %d directories" % len(self)
+
+    def walk(self, directory):
+        """
+        Yields an INodeFile for each regular file below 'directory'.
+
+        Directories that were removed are removed from the cache too.
+        """
+        seen = set()
+        directories = [directory]
+        while directories:
+            current = directories.pop()
+            try:
+                dir_stat = os.lstat(current)
+            except OSError:
+                verbose("Directory not found: %s" % current, DEBUG)
+                continue
+            seen.add(current)
+
+            entry = self.directories.get(current)
+            if (entry is not None and entry[0] == dir_stat.st_mtime and
+                    entry[1] == dir_stat.st_ctime):
+                self.reused += 1
+                subdirs, files = entry[2], entry[3]
+            else:
+                self.listed += 1
+                subdirs, files = self.list_directory(current)
+                self.directories[current] = (dir_stat.st_mtime,
+                                             dir_stat.st_ctime, subdirs, files)
+
+            for name, inode, size in files:
+                yield INodeFile('%d\0%d\0\0\0\0%s'
+                                % (inode, size, os.path.join(current, name)))
+            directories.extend(os.path.join(current, name) for name in subdirs)
+
+        prefix = os.path.join(directory, '')
+        for path in list(self.directories):
+            if path not in seen and (path == directory or path.startswith(prefix)):
+                del self.directories[path]
+
+    def list_directory(self, directory):
+        """
+        Returns the names of the subdirectories and a list of (name, inode,
+        size) tuples for the regular files in 'directory'.
+        """
+        subdirs = []
+        files = []
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            verbose("Can not read %s" % directory, DEBUG)
+            return subdirs, files
+
+        for name in sorted(names):
+            try:
+                file_stat = os.lstat(os.path.join(directory, name))
+            except OSError:
+                continue
+            if stat.S_ISDIR(file_stat.st_mode):
+                subdirs.append(name)
+            elif stat.S_ISREG(file_stat.st_mode):
+                files.append((name, file_stat.st_ino, file_stat.st_size))
+        return subdirs, files
+
+    def dump(self, path=None):
+        """
+        Saves the cache in a file.
+
+        'path' defaults to the path the cache was created with.
+        """
+        with open(path or self.path, 'w') as f:
+            for directory, (mtime, ctime, subdirs, files) in self.directories.items():
+                f.write('D\0%s\0%r\0%r\0%s\n'
+                        % (directory, mtime, ctime, '\0'.join(subdirs)))
+                for name, inode, size in files:
+                    f.write('F\0%s\0%d\0%d\n' % (name, inode, size))
+
+    def load(self, path):
+        """
+        Loads the cache from a file.
+        """
+        verbose("Load directory cache %s" % path, INFO)
+        with open(path) as f:
+            files = None
+            for line in f:
+                data = line.rstrip('\n').split('\0')
+                if data[0] == 'D':
+                    files = []
+                    subdirs = [name for name in data[4:] if name]
+                    self.directories[data[1]] = (float(data[2]), float(data[3]),
+                                                 subdirs, files)
+                else:
+                    files.append((data[1], int(data[2]), int(data[3])))
@@ -0,0 +1,108 @@
+import math
+import random
+
+from .inode import INodeFileList
+
+
+class SavingsEstimate(object):
+    """
+    The projected bytes a merge would reclaim.
+
+    Attributes
+    ----------
+    estimate: the projected reclaimable bytes
+    low: the lower bound of the confidence interval
+    high: the upper bound of the confidence interval
+    confidence: the confidence level of the interval
+    upper_bound: the reclaimable bytes if all files with the same size were
+                 identical
+    groups: the number of groups of files with the same size
+    sampled: the number of groups that were hashed
+    """
+    def __init__(self, estimate, low, high, confidence, upper_bound, groups,
+                 sampled):
+        self.estimate = estimate
+        self.low = low
+        self.high = high
+        self.confidence = confidence
+        self.upper_bound = upper_bound
+        self.groups = groups
+        self.sampled = sampled
+
+    def __repr__(self):
+        return "%d bytes (%d - %d with %d%% confidence, %d of %d groups sampled)" % (
+            self.estimate, self.low, self.high, self.confidence * 100,
+            self.sampled, self.groups)
+
+
+def z_value(confidence):
+    """
+    Returns the z value of the normal distribution for a two sided
+    confidence interval.
+    """
+    low, high = 0.0, 10.0
+    for i in range(100):
+        middle = (low + high) / 2
+        if math.erf(middle / math.sqrt(2)) < confidence:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+
+def reclaimable_sample(size_list):
+    """
+    Returns the bytes that could be reclaimed in 'size_list'.
+
+    The INodeFiles are compared by their sample_md5sum, so only three blocks
+    of each file are read.
+    """
+    sample_lists = {}
+    for item in size_list:
+        sample_lists.setdefault(item.sample_md5sum, INodeFileList()).add(item)
+    return sum(sample_list.reclaimable_size()
+               for sample_list in sample_lists.values())
+
+
+def estimate_savings(inode_file_list, sample_size=100, confidence=0.95,
+                     seed=None):
+    """
+    Estimates the bytes that a merge of 'inode_file_list' would reclaim.
+
+    The groups of files with the same size are the population. A random
+    sample of 'sample_size' groups is compared by their sample_md5sum. The
+    share of the possible savings, that is found in the sample, is projected
+    on all groups (a ratio estimator).
+
+    Returns a SavingsEstimate.
+    """
+    if len(inode_file_list):
+        size_lists = list(inode_file_list.iter_list('size'))
+    else:
+        size_lists = []
+    upper_bounds = [size_list.reclaimable_size() for size_list in size_lists]
+    upper_bound = sum(upper_bounds)
+    count = len(size_lists)
+    if not upper_bound:
+        return SavingsEstimate(0, 0, 0, confidence, 0, count, 0)
+
+    indexes = random.Random(seed).sample(range(count), min(sample_size, count))
+    xs = [upper_bounds[index] for index in indexes]
+    ys = [reclaimable_sample(size_lists[index]) for index in indexes]
+    n = len(indexes)
+    ratio = float(sum(ys)) / sum(xs) if sum(xs) else 0.0
+    estimate = ratio * upper_bound
+
+    if n > 1 and n < count:
+        residuals = sum((y - ratio * x) ** 2 for x, y in zip(xs, ys)) / (n - 1)
+        variance = count ** 2 * (1 - float(n) / count) * residuals / n
+        error = z_value(confidence) * math.sqrt(variance)
+    elif n == count:
+        # Every group was sampled.
+        error = 0
+    else:
+        error = upper_bound
+    low = max(estimate - error, 0)
+    high = min(estimate + error, upper_bound)
+    return SavingsEstimate(int(estimate), int(low), int(high), confidence,
+                           upper_bound, count, n)
@@ -0,0 +1,161 @@
+import os
+
+from .inode import INodeFile, INodeFileList
+from .utils import verbose, WARNING, INFO, DEBUG
+
+
+class ContentIndex(object):
+    """
+    A persistent index of the content that was already seen.
+
+    The index holds one canonical INodeFile with one live path for each
+    distinct content. New files are only compared against the canonical files
+    with the same size, so the work to merge a new snapshot is proportional to
+    the snapshot and not to the whole archive.
+
+    Attributes
+    ----------
+    path: the file where the index is saved
+    inode_files: an INodeFileList with all canonical INodeFiles
+    sizes: a dict that maps a size to a list of canonical INodeFiles
+    """
+    def __init__(self, path=None):
+        """
+        'path' is the file where the index is saved. If it exists, the index
+        is loaded from it.
+        """
+        self.path = path
+        self.inode_files = INodeFileList()
+        self.sizes = {}
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        """
+        Returns the number of canonical INodeFiles.
+        """
+        return len(self.inode_files)
+
+    def __repr__(self):
+        return "index with %d INodeFiles" % len(self)
+
+    def __contains__(self, item):
+        return item in self.inode_files
+
+    def register(self, item):
+        """
+        Adds a copy of an INodeFile with one of its paths as canonical file
+        for its content.
+        """
+        canonical = INodeFile(item.dump())
+        canonical.files = set([item.file])
+        self.inode_files.add(canonical)
+        self.sizes.setdefault(canonical.size, []).append(canonical)
+
+    def unregister(self, item):
+        """
+        Removes an INodeFile from the index.
+        """
+        del self.inode_files[item]
+        candidates = self.sizes[item.size]
+        candidates.remove(item)
+        if not candidates:
+            del self.sizes[item.size]
+
+    def alive(self, canonical):
+        """
+        Removes the paths of 'canonical', that do not point to its inode
+        anymore.
+
+        Returns False and removes 'canonical' from the index, if no path is
+        left.
+        """
+        for path in list(canonical.files):
+            try:
+                if os.lstat(path).st_ino == canonical.inode:
+                    continue
+            except OSError:
+                pass
+            canonical.files.discard(path)
+        if not canonical.files:
+            # The snapshot with the canonical file was deleted.
+            verbose("Drop stale index entry %d" % canonical.inode, DEBUG)
+            self.unregister(canonical)
+            return False
+        return True
+
+    def lookup(self, item):
+        """
+        Returns the canonical INodeFile with the same content as 'item' or None.
+
+        Only the canonical files with the same size as 'item' are hashed.
+        Canonical files whose paths are gone are removed from the index and
+        canonical files that can not be read are skipped.
+
+        Raises OSError, if 'item' can not be read.
+        """
+        for candidate in list(self.sizes.get(item.size, [])):
+            prefix_md5sum = item.prefix_md5sum
+            try:
+                if candidate.prefix_md5sum != prefix_md5sum:
+                    continue
+                sha1sum = candidate.sha1sum
+            except OSError:
+                if self.alive(candidate):
+                    verbose("Can not read %s" % candidate.file, WARNING)
+                continue
+            if sha1sum == item.sha1sum and self.alive(candidate):
+                return candidate
+        return None
+
+    def merge(self, inode_file_list, demo=False):
+        """
+        Merges the INodeFiles from 'inode_file_list' into the index.
+
+        Each INodeFile is merged into the canonical file with the same content.
+        INodeFiles with a new content become canonical files. INodeFiles
+        that can not be read are skipped.
+
+        Returns an INodeFileList with all merged INodeFiles.
+        """
+        merged_items = INodeFileList()
+        for item in inode_file_list:
+            if item in self:
+                # A hardlink to a known inode. Remember a new path, because
+                # it lives longer then the paths from older snapshots.
+                self.inode_files[item].files = set([item.file])
+                continue
+
+            try:
+                canonical = self.lookup(item)
+            except OSError:
+                verbose("Can not read %s" % item.file, WARNING)
+                continue
+            if canonical is None:
+                self.register(item)
+                continue
+
+            if not demo:
+                if not canonical.merge(item):
+                    continue
+                canonical.files = set([item.file])
+            merged_items.add(item)
+        if not demo:
+            del inode_file_list[merged_items]
+        return merged_items
+
+    def dump(self, path=None):
+        """
+        Saves the index in a file.
+
+        'path' defaults to the path the index was created with.
+        """
+        self.inode_files.dump(path or self.path)
+
+    def load(self, path):
+        """
+        Loads the index from a file.
+        """
+        verbose("Load index %s" % path, INFO)
+        for item in INodeFileList(load=path):
+            self.register(item)
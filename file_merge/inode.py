@@ -9,6 +9,21 @@ import sys
 if sys.version_info[1] < 3:
     FileNotFoundError = OSError
 
+# Files up to this size are read only once to merge them.
+SMALL_FILE_LIMIT = 64 * 1024
+
+
+def fix_test_case(block):
+    """
+    Fix for the testing famework
+
+    The open-method from fake_filesystem does return str instead of
+    bytes object.
+    """
+    if type(block) is str:
+        block = bytes(block, encoding='utf-8')
+    return block
+
 
 class INodeFile(object):
     """
@@ -23,7 +38,13 @@ class INodeFile(object):
     md5sum: the md5sum of the file
     sha1sum: the sha1sum of the file
     size: the size of the file
+
+    The class attribute bytes_read counts the bytes that were read to hash
+    files.
     """
+    bytes_read = 0
+    content_stages = ('size', 'prefix_md5sum', 'md5sum', 'sha1sum')
+
     def __init__(self, firstfile):
         """
         firstfile: The absolut path to a file.
@@ -58,18 +79,27 @@ class INodeFile(object):
 
     def __eq__(self, other):
         """
-        Compares two INodeFile objects.
+        Two INodeFile objects are equal, if they have the same inode.
+
+        The files are never read. Use same_content to compare the content.
+        """
+        if not isinstance(other, INodeFile):
+            return NotImplemented
+        return self.inode == other.inode
+
+    def same_content(self, other):
+        """
+        Compares the content of two INodeFile objects.
+
+        The attributes in content_stages are compared in order, so a file is
+        only read if the cheaper attributes are the same. The hashes are
+        cached.
         """
         if self.inode == other.inode:
             return True
-        if self.size != other.size:
-            return False
-        if self.prefix_md5sum != other.prefix_md5sum:
-            return False
-        if self.md5sum != other.md5sum:
-            return False
-        if self.sha1sum != other.sha1sum:
-            return False
+        for attribute in self.content_stages:
+            if getattr(self, attribute) != getattr(other, attribute):
+                return False
         # They propably are the same
         return True
 
@@ -101,7 +131,7 @@ class INodeFile(object):
         Returns True if the inode matches, else False.
         """
         if type(path) is INodeFile:
-            if self == path:
+            if self.inode == path.inode:
                 self.files.update(path.files)
                 return True
             return False
@@ -118,30 +148,51 @@ class INodeFile(object):
             return True
         return False
 
-    def hash(self, algo, only_first_part=False):
+    def hash(self, algo, only_first_part=False, offsets=None):
         """
         Returns an hash of the file.
-        """
-        def fix_test_case(block):
-            """
-            Fix for the testing famework
-
-            The open-method from fake_filesystem does return str instead of
-            bytes object.
-            """
-            if type(block) is str:
-                block = bytes(block, encoding='utf-8')
-            return block
 
+        If 'offsets' is a list of positions, only one block at each position
+        is hashed.
+        """
         with open(self.file, 'rb') as f:
+            if offsets is not None:
+                for offset in offsets:
+                    f.seek(offset)
+                    block = fix_test_case(f.read(1280))
+                    INodeFile.bytes_read += len(block)
+                    algo.update(block)
+                return algo.hexdigest()
+
             block = fix_test_case(f.read(1280))
             while block:
+                INodeFile.bytes_read += len(block)
                 algo.update(block)
                 if only_first_part:
                     break
                 block = fix_test_case(f.read(1280))
         return algo.hexdigest()
 
+    def read_hashes(self):
+        """
+        Reads the file once and caches the prefix_md5sum, the md5sum and the
+        sha1sum.
+        """
+        prefix_md5 = hashlib.md5()
+        md5 = hashlib.md5()
+        sha1 = hashlib.sha1()
+        with open(self.file, 'rb') as f:
+            block = fix_test_case(f.read(1280))
+            prefix_md5.update(block)
+            while block:
+                INodeFile.bytes_read += len(block)
+                md5.update(block)
+                sha1.update(block)
+                block = fix_test_case(f.read(1280))
+        self._prefix_md5sum = prefix_md5.hexdigest()
+        self._md5sum = md5.hexdigest()
+        self._sha1sum = sha1.hexdigest()
+
     @property
     def prefix_md5sum(self):
         """
@@ -153,6 +204,22 @@ class INodeFile(object):
             self._prefix_md5sum = self.hash(hashlib.md5(), only_first_part=True)
             return self._prefix_md5sum
 
+    @property
+    def sample_md5sum(self):
+        """
+        Returns the md5sum of the first, the middle and the last part of the
+        file.
+        """
+        try:
+            return self._sample_md5sum
+        except AttributeError:
+            if self.size <= 3 * 1280:
+                offsets = None
+            else:
+                offsets = [0, self.size // 2, self.size - 1280]
+            self._sample_md5sum = self.hash(hashlib.md5(), offsets=offsets)
+            return self._sample_md5sum
+
     @property
     def md5sum(self):
         """
@@ -175,26 +242,66 @@ class INodeFile(object):
             self._sha1sum = self.hash(hashlib.sha1())
             return self._sha1sum
 
+    @property
+    def nlink(self):
+        """
+        Returns the number of hardlinks to the inode.
+
+        If the filesystem does not know it, the number of paths is returned.
+        """
+        try:
+            return self._nlink
+        except AttributeError:
+            try:
+                nlink = os.lstat(self.file).st_nlink
+            except OSError:
+                nlink = None
+            self._nlink = nlink or len(self.files)
+            return self._nlink
+
+    @property
+    def complete(self):
+        """
+        Returns True if all hardlinks to the inode are known.
+
+        The space of an inode is only freed, if all its hardlinks are merged.
+        """
+        return len(self.files) >= self.nlink
+
     def merge(self, other):
         """
         Merge other into self.
 
         'other' has to be an INodeFile.
+
+        Returns True if all paths of other were relinked.
         """
         # mv other to backup
         # create new hardlink to other
         # rm the backup
-        for path in other.files:
+        relinked = True
+        for path in list(other.files):
             backup = path + '.file_merge-bu'
             try:
                 os.rename(path, backup)
-                os.link(self.file, path)
-                os.remove(backup)
             except OSError:
                 verbose('No rights for %s' % path, WARNING)
-            else:
-                self.addfile(path)
+                relinked = False
+                continue
+            try:
+                os.link(self.file, path)
+            except OSError:
+                # Put the original file back.
+                os.rename(backup, path)
+                verbose('Can not link %s to %s' % (self.file, path), WARNING)
+                relinked = False
+                continue
+            os.remove(backup)
+            self.addfile(path)
+            if hasattr(self, '_nlink'):
+                self._nlink += 1
         other.merged_into = self
+        return relinked
 
     def dump(self):
         """
@@ -212,7 +319,7 @@ class INodeFileList(object):
     """
     A list of INodeFile objects.
     """
-    def __init__(self, directory=None, load=None):
+    def __init__(self, directory=None, load=None, cache=None):
         """
         Saves the INodeFile object in a SortableDict.
 
@@ -225,12 +332,14 @@ class INodeFileList(object):
 
         'load' has to be a path to a dumped INodeFileList-file. It will be
         loaded.
+
+        'cache' can be a DirectoryCache. It is used to walk the directory.
         """
         self.storage = SortableDict()
         if load is not None:
             self.load(load)
         elif directory is not None:
-            self.add(directory)
+            self.add(directory, cache)
 
     def __getitem__(self, item):
         """
@@ -297,6 +406,8 @@ class INodeFileList(object):
 
         'sort_attribute' decide which attribute is used.
         """
+        if not len(self):
+            return
         iter_list = INodeFileList()
         self.sort_by_attribute(sort_attribute)
 
@@ -332,9 +443,12 @@ class INodeFileList(object):
         """
         return self.storage.value_for_index(index)
 
-    def add(self, item):
+    def add(self, item, cache=None):
         """
         Add a INodeFile to the object.
+
+        If 'item' is a directory and 'cache' is a DirectoryCache, unchanged
+        directories are taken from the cache.
         """
         if type(item) is str:
             try:
@@ -342,7 +456,10 @@ class INodeFileList(object):
             except FileNotFoundError:
                 verbose("File not found: %s" % item, DEBUG)
                 return
-            if stat.S_ISDIR(mode):
+            if stat.S_ISDIR(mode) and cache is not None:
+                for inode_file in cache.walk(item):
+                    self.add(inode_file)
+            elif stat.S_ISDIR(mode):
                 # TODO: Check relativ path
                 root_len = len(item.split('/'))
                 for root, dirs, files in os.walk(item):
@@ -372,9 +489,14 @@ class INodeFileList(object):
         """
         return self.storage.popitem(*args)[1]
 
-    def merge(self, demo=False):
+    def merge(self, demo=False, small_file_limit=SMALL_FILE_LIMIT):
         """
         Merge any INodeFile with a propably identicly together.
+
+        If 'demo' is True, the files are hashed but not merged.
+
+        Files up to 'small_file_limit' bytes are read only once, see
+        merge_small_files.
         """
         def status(size_list):
             first_file = size_list.value_for_index(0)
@@ -385,17 +507,97 @@ class INodeFileList(object):
         # Look for identical Items and merge them
         for size_list in self.iter_list('size'):
             status(size_list)
-            for prefix_md5sum_list in size_list.iter_list('prefix_md5sum'):
-                for md5sum_list in prefix_md5sum_list.iter_list('md5sum'):
-                    for sha1sum_list in md5sum_list.iter_list('sha1sum'):
-                        # Any element in sha1sum_list should be identical.
-                        base_item = sha1sum_list.popitem()
-                        for item in sha1sum_list:
-                            base_item.merge(item)
-                        merged_items.add(sha1sum_list)
-        del self[merged_items]
+            merged_items.add(size_list.merge_size_list(demo, small_file_limit))
+        if not demo:
+            del self[merged_items]
+        return merged_items
+
+    def merge_size_list(self, demo=False, small_file_limit=SMALL_FILE_LIMIT):
+        """
+        Merge the INodeFiles from this object, which all have the same size.
+
+        If 'demo' is True, the files are hashed but not merged.
+
+        If the size is not bigger then 'small_file_limit', merge_small_files
+        is used.
+
+        Returns an INodeFileList with the merged INodeFiles.
+        """
+        if self.value_for_index(0).size <= small_file_limit:
+            return self.merge_small_files(demo)
+
+        merged_items = INodeFileList()
+        for prefix_md5sum_list in self.iter_list('prefix_md5sum'):
+            for md5sum_list in prefix_md5sum_list.iter_list('md5sum'):
+                for sha1sum_list in md5sum_list.iter_list('sha1sum'):
+                    # Any element in sha1sum_list should be identical.
+                    merged_items.add(sha1sum_list.merge_identical(demo))
+        return merged_items
+
+    def merge_small_files(self, demo=False):
+        """
+        Merge the INodeFiles from this object by reading each file only once.
+
+        The files are read in the order of their inodes and grouped by their
+        size and hashes.
+
+        Returns an INodeFileList with the merged INodeFiles.
+        """
+        identical_lists = SortableDict()
+        for item in sorted(self, key=lambda item: item.inode):
+            if not hasattr(item, '_sha1sum') or not hasattr(item, '_md5sum'):
+                item.read_hashes()
+            key = (item.size, item.md5sum, item.sha1sum)
+            identical_lists.setdefault(key, INodeFileList()).add(item)
+
+        merged_items = INodeFileList()
+        for identical_list in identical_lists.values():
+            if len(identical_list) > 1:
+                merged_items.add(identical_list.merge_identical(demo))
         return merged_items
 
+    def merge_identical(self, demo=False):
+        """
+        Merge the INodeFiles from this object, which all are identical.
+
+        INodeFiles with hardlinks outside of this object are not merged,
+        because their space would not be freed.
+
+        Returns an INodeFileList with the merged INodeFiles. INodeFiles that
+        could not be relinked completely are not in it.
+        """
+        merged_items = INodeFileList()
+        base_item = self.pop_merge_target()
+        for item in self:
+            if item.complete and (demo or base_item.merge(item)):
+                merged_items.add(item)
+        return merged_items
+
+    def pop_merge_target(self):
+        """
+        Removes and returns the INodeFile the others should be merged into.
+
+        An INodeFile with hardlinks outside of this object can not be freed,
+        so it is the best target. Else the INodeFile with the most paths is
+        taken, so the fewest paths have to be relinked.
+        """
+        target = max(self, key=merge_target_key)
+        del self[target]
+        return target
+
+    def reclaimable_size(self):
+        """
+        Returns the bytes that are freed, if all INodeFiles in this object
+        are identical and merged together.
+
+        INodeFiles with hardlinks outside of this object do not free any
+        space.
+        """
+        sizes = [item.size for item in self if item.complete]
+        if len(sizes) == len(self) and sizes:
+            sizes.remove(max(sizes))
+        return sum(sizes)
+
     def dump(self, path):
         """
         Saves the object in a file.
@@ -404,14 +606,18 @@ class INodeFileList(object):
             for item in self:
                 save_file.write('%s\n' % item.dump())
 
-    def load(self, path):
+    def load(self, path, sizes=None):
         """
         Loads the object from a file.
+
+        If 'sizes' is a set, only the INodeFiles with one of these sizes are
+        loaded. See colliding_sizes.
         """
         with open(path) as f:
-            for line in f.readlines():
-                item = INodeFile(line.strip())
-                self.storage[item.inode] = item
+            for line in f:
+                if sizes is not None and int(line.split('\0', 2)[1]) not in sizes:
+                    continue
+                self.add(INodeFile(line.strip()))
 
     def size(self, meter='b'):
         # TODO: interpretate meter. Maby there is a lib?
@@ -419,3 +625,35 @@ class INodeFileList(object):
         for f in self:
             count += f.size
         return count
+
+
+def colliding_sizes(paths):
+    """
+    Returns a set of the sizes, that more then one inode has in the dumped
+    INodeFileList-files at 'paths'.
+
+    Only the inode and the size of each line are parsed, so this is much
+    cheaper then loading the files.
+    """
+    first_inodes = {}
+    sizes = set()
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                inode, size = line.split('\0', 2)[:2]
+                size = int(size)
+                if size in sizes:
+                    continue
+                inode = int(inode)
+                if first_inodes.setdefault(size, inode) != inode:
+                    sizes.add(size)
+                    del first_inodes[size]
+    return sizes
+
+
+def merge_target_key(item):
+    """
+    Returns a sort key for an INodeFile. The INodeFile with the biggest key
+    is the best target to merge identical INodeFiles into.
+    """
+    return (not item.complete, len(item))
@@ -0,0 +1,269 @@
+import asyncio
+import os
+import stat
+
+from .inode import INodeFile, INodeFileList, merge_target_key
+from .utils import verbose, WARNING, DEBUG
+
+
+def scan_directory(directory):
+    """
+    Returns the INodeFiles of the regular files in 'directory' and the paths
+    of its subdirectories.
+    """
+    inode_files = []
+    directories = []
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        verbose("Can not read %s" % directory, WARNING)
+        return inode_files, directories
+
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            mode = os.lstat(path).st_mode
+            if stat.S_ISDIR(mode):
+                directories.append(path)
+            elif stat.S_ISREG(mode):
+                inode_files.append(INodeFile(path))
+        except OSError:
+            verbose("File not found: %s" % path, DEBUG)
+    return inode_files, directories
+
+
+def collide(groups, key, item):
+    """
+    Adds 'item' to the group 'key' in the dict 'groups'.
+
+    Returns the items, that have to be passed to the next stage. These are
+    both items, when the second item is added to a group, and the new item
+    for any further item.
+    """
+    group = groups.setdefault(key, [])
+    group.append(item)
+    if len(group) == 2:
+        return group[:]
+    elif len(group) > 2:
+        return [item]
+    return []
+
+
+class Pipeline(object):
+    """
+    Scans a directory and merges identical files in overlapping stages.
+
+    The stages are connected with bounded queues, so a slow stage slows down
+    the stages before it:
+
+    * walk: lists the directories and creates the INodeFiles
+    * group: groups the INodeFiles by their size
+    * hash: computes the prefix_md5sum of files with a colliding size
+    * confirm: computes the md5sum and sha1sum of files with a colliding
+      prefix_md5sum
+    * plan: groups the files by their content and chooses the merge targets
+    * link: merges the files
+
+    A group of files with the same size is hashed as soon as it has two
+    members, while the walk is still running. The blocking calls run in a
+    thread pool, so reading files and metadata operations overlap.
+
+    The pipeline needs Python 3.7 or newer.
+    """
+    def __init__(self, directory, queue_size=1000, hashers=4, demo=False):
+        """
+        'directory' is the path to scan.
+
+        'queue_size' is the maximum number of items between two stages.
+
+        'hashers' is the number of files that are hashed at the same time.
+
+        If 'demo' is True, the files are hashed but not merged.
+        """
+        self.directory = directory
+        self.queue_size = queue_size
+        self.hashers = hashers
+        self.demo = demo
+        self.inode_files = INodeFileList()
+        self.merged_items = INodeFileList()
+        # Maps the inodes, that were passed to the link stage, to their
+        # target.
+        self.scheduled = {}
+
+    def run(self):
+        """
+        Runs the pipeline.
+
+        Returns an INodeFileList with the merged INodeFiles. The INodeFiles
+        that were not merged are in the attribute inode_files.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.run_stages())
+        finally:
+            loop.close()
+        if not self.demo:
+            del self.inode_files[self.merged_items]
+        return self.merged_items
+
+    async def run_blocking(self, function, *args):
+        """
+        Runs 'function' in the thread pool.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, function, *args)
+
+    async def close(self, queue, consumers):
+        """
+        Tells 'consumers' consumers of 'queue', that there are no more items.
+        """
+        for i in range(consumers):
+            await queue.put(None)
+
+    async def items(self, queue, producers=1):
+        """
+        Yields the items from 'queue' until all 'producers' are done.
+        """
+        while producers:
+            item = await queue.get()
+            if item is None:
+                producers -= 1
+            else:
+                yield item
+
+    async def run_stages(self):
+        queue_size = self.queue_size
+        self.files = asyncio.Queue(queue_size)
+        self.prefix_queue = asyncio.Queue(queue_size)
+        self.prefixed = asyncio.Queue(queue_size)
+        self.confirm_queue = asyncio.Queue(queue_size)
+        self.confirmed = asyncio.Queue(queue_size)
+        self.links = asyncio.Queue(queue_size)
+
+        tasks = [self.walk(), self.group(), self.group_prefix(), self.plan(),
+                 self.link()]
+        for i in range(self.hashers):
+            tasks.append(self.hash(self.prefix_queue, self.prefixed,
+                                   self.hash_prefix))
+            tasks.append(self.hash(self.confirm_queue, self.confirmed,
+                                   self.hash_content))
+        await asyncio.gather(*tasks)
+
+    async def walk(self):
+        directories = [self.directory]
+        while directories:
+            directory = directories.pop()
+            inode_files, subdirectories = await self.run_blocking(
+                scan_directory, directory)
+            directories.extend(subdirectories)
+            for item in inode_files:
+                await self.files.put(item)
+        await self.close(self.files, 1)
+
+    async def group(self):
+        sizes = {}
+        async for item in self.items(self.files):
+            if item in self.inode_files:
+                # A further hardlink to a known inode.
+                known = self.inode_files[item]
+                target = self.scheduled.get(known.inode)
+                if target is None:
+                    known.addfile(item)
+                else:
+                    # 'known' can already be merged in the thread pool, so
+                    # the new path is merged on its own.
+                    await self.links.put((target, item))
+                continue
+
+            self.inode_files.add(item)
+            if item.size <= 0:
+                continue
+            for candidate in collide(sizes, item.size, item):
+                await self.prefix_queue.put(candidate)
+        await self.close(self.prefix_queue, self.hashers)
+
+    async def hash(self, source, target, function):
+        async for item in self.items(source):
+            try:
+                await self.run_blocking(function, item)
+            except OSError:
+                verbose("Can not read %s" % item, WARNING)
+                continue
+            await target.put(item)
+        await self.close(target, 1)
+
+    @staticmethod
+    def hash_prefix(item):
+        return item.prefix_md5sum
+
+    @staticmethod
+    def hash_content(item):
+        return item.md5sum, item.sha1sum
+
+    async def group_prefix(self):
+        prefixes = {}
+        async for item in self.items(self.prefixed, self.hashers):
+            for candidate in collide(prefixes, (item.size, item.prefix_md5sum),
+                                     item):
+                await self.confirm_queue.put(candidate)
+        await self.close(self.confirm_queue, self.hashers)
+
+    async def plan(self):
+        """
+        Chooses the targets like INodeFileList.pop_merge_target.
+
+        The target of a group is fixed with its first link. Files that are
+        not complete yet are held back until the walk is done. If one of them
+        has hardlinks outside of the directory, it becomes the target and
+        the old target is merged into it with all paths that were already
+        linked to the old target.
+        """
+        targets = {}
+        linked = set()
+        pending = {}
+        async for item in self.items(self.confirmed, self.hashers):
+            key = (item.size, item.md5sum, item.sha1sum)
+            target = targets.setdefault(key, item)
+            if target is item:
+                continue
+            if not item.complete:
+                # The walk can still find further hardlinks to 'item'.
+                pending.setdefault(key, []).append(item)
+                continue
+            if key not in linked:
+                linked.add(key)
+                target, item = sorted([target, item], key=merge_target_key,
+                                      reverse=True)
+                targets[key] = target
+            await self.schedule(target, item)
+
+        # The stages before are done, so all hardlinks inside of the
+        # directory are known now. Wait for the running links, so the paths
+        # of the targets do not change anymore.
+        await self.links.join()
+        for key, items in pending.items():
+            target = targets[key]
+            outside = [item for item in items if not item.complete]
+            if outside and target.complete:
+                # The files in 'outside' can not be freed, but the target
+                # can, if it is merged into one of them.
+                new_target = max(outside, key=merge_target_key)
+                await self.schedule(new_target, target)
+                target = new_target
+            for item in items:
+                if item.complete:
+                    await self.schedule(target, item)
+        await self.close(self.links, 1)
+
+    async def schedule(self, target, item):
+        """
+        Passes 'item' to the link stage to be merged into 'target'.
+        """
+        self.scheduled[item.inode] = target
+        await self.links.put((target, item))
+
+    async def link(self):
+        async for target, item in self.items(self.links):
+            if self.demo or await self.run_blocking(target.merge, item):
+                self.merged_items.add(item)
+            self.links.task_done()
@@ -0,0 +1,287 @@
+import builtins
+import cProfile
+import functools
+import inspect
+import time
+
+from . import inode
+from .inode import INodeFile, INodeFileList
+
+# resource and tracemalloc are not available on any platform or version.
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Without tracemalloc.reset_peak (Python < 3.9) only the peak of the whole
+# process is known.
+PHASE_PEAK_ALLOC = hasattr(tracemalloc, 'reset_peak')
+
+
+class Phase(object):
+    """
+    The measurements of one hot path.
+
+    The wall time, the bytes and the os calls are exclusive, so the time of
+    a nested phase is not counted for the outer phase. The peak of the
+    allocated memory includes the nested phases. The peak rss is the peak of
+    the process at the end of the phase, because it can not be reset.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall_time = 0.0
+        self.bytes_read = 0
+        self.os_calls = 0
+        self.peak_rss = 0
+        self.peak_alloc = 0
+
+    def __repr__(self):
+        text = ("%s: %d calls, %.3fs, %d bytes read, %d os calls in inode.py, "
+                "process peak rss %d KiB" % (
+                    self.name, self.calls, self.wall_time, self.bytes_read,
+                    self.os_calls, self.peak_rss))
+        if self.peak_alloc:
+            # Only set when the allocations are traced.
+            text += ", %s %d KiB" % (
+                'peak alloc' if PHASE_PEAK_ALLOC else 'process peak alloc',
+                self.peak_alloc // 1024)
+        return text
+
+
+class CountingOS(object):
+    """
+    Wraps the os module and counts the calls to its functions.
+
+    The wrapper for each name is created once and then cached as attribute.
+    """
+    def __init__(self, os_module, profiler):
+        self._os = os_module
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        value = getattr(self._os, name)
+        if callable(value):
+            value = self._profiler.count(value)
+        setattr(self, name, value)
+        return value
+
+
+class Profiler(object):
+    """
+    Measures the scan and merge hot paths.
+
+    While the profiler is enabled, INodeFileList.add, INodeFileList.iter_list,
+    INodeFile.hash and INodeFile.read_hashes are wrapped with timers. The
+    report shows the calls, wall time, bytes read, os calls and peak memory
+    for each of them.
+
+    Only the calls of the os module and of open in file_merge.inode are
+    counted. They are not the same as syscalls: os.walk counts as one call
+    for each directory, and the other modules are not counted at all.
+
+    If 'allocations' is True, the peak of the allocated memory is traced with
+    tracemalloc. This slows down the program.
+
+    If 'cprofile' is True, a cProfile profile is recorded too. It can be saved
+    with dump_stats and converted to a flamegraph with tools like flameprof.
+
+    The profiler can be used as context manager.
+    """
+    hooks = [(INodeFileList, 'add'),
+             (INodeFileList, 'iter_list'),
+             (INodeFile, 'hash'),
+             (INodeFile, 'read_hashes')]
+
+    def __init__(self, allocations=False, cprofile=False):
+        self.phases = {}
+        self.os_calls = 0
+        self.allocations = allocations
+        self.cprofile = cProfile.Profile() if cprofile else None
+        self._tracemalloc_started = False
+        self._stack = []
+        self._originals = []
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *args):
+        self.disable()
+
+    def counters(self):
+        """
+        Returns the current time, bytes read and os calls.
+        """
+        return (time.time(), INodeFile.bytes_read, self.os_calls)
+
+    def enter(self, name):
+        """
+        Starts to measure the phase 'name'.
+        """
+        counters = self.counters()
+        if self._stack:
+            self.account(self._stack[-1], counters)
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase(name)
+        phase.calls += 1
+        self._stack.append([phase, counters, self.start_alloc_peak()])
+
+    def leave(self):
+        """
+        Stops to measure the current phase.
+        """
+        counters = self.counters()
+        entry = self._stack.pop()
+        self.account(entry, counters)
+        self.measure_memory(entry)
+        if self._stack:
+            self._stack[-1][1] = self.counters()
+
+    def account(self, entry, counters):
+        """
+        Adds the difference between the counters of the entry and 'counters'
+        to the phase of the entry.
+        """
+        phase, start = entry[:2]
+        phase.wall_time += counters[0] - start[0]
+        phase.bytes_read += counters[1] - start[1]
+        phase.os_calls += counters[2] - start[2]
+        entry[1] = counters
+
+    def start_alloc_peak(self):
+        """
+        Starts to trace the peak of the allocated memory for a new phase.
+
+        The peak so far is saved in the running phases, then the peak is
+        reset. Returns the allocated memory at the start.
+        """
+        if tracemalloc is None or not tracemalloc.is_tracing():
+            return 0
+        current, peak = tracemalloc.get_traced_memory()
+        if PHASE_PEAK_ALLOC:
+            for entry in self._stack:
+                entry[2] = max(entry[2], peak)
+            tracemalloc.reset_peak()
+        return current
+
+    def measure_memory(self, entry):
+        """
+        Saves the peak memory of the phase of 'entry'.
+        """
+        phase = entry[0]
+        if resource is not None:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            phase.peak_rss = max(phase.peak_rss, rss)
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            peak = max(entry[2], tracemalloc.get_traced_memory()[1])
+            phase.peak_alloc = max(phase.peak_alloc, peak)
+            if PHASE_PEAK_ALLOC:
+                for outer in self._stack:
+                    outer[2] = max(outer[2], peak)
+
+    def count(self, function):
+        """
+        Returns a wrapper for 'function', that counts its calls as os calls.
+        """
+        @functools.wraps(function)
+        def counted(*args, **kwargs):
+            self.os_calls += 1
+            return function(*args, **kwargs)
+        return counted
+
+    def wrap(self, name, function):
+        """
+        Returns a wrapper for 'function', that measures the phase 'name'.
+        """
+        profiler = self
+
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                generator = function(*args, **kwargs)
+                while True:
+                    profiler.enter(name)
+                    try:
+                        value = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        profiler.leave()
+                    yield value
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                profiler.enter(name)
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    profiler.leave()
+        return wrapper
+
+    def enable(self):
+        """
+        Wraps the hot paths.
+        """
+        for cls, attribute in self.hooks:
+            function = cls.__dict__[attribute]
+            self._originals.append((cls, attribute, function))
+            name = '%s.%s' % (cls.__name__, attribute)
+            setattr(cls, attribute, self.wrap(name, function))
+        self._originals.append((inode, 'os', inode.os))
+        inode.os = CountingOS(inode.os, self)
+        self._originals.append((inode, 'open', inode.__dict__.get('open')))
+        inode.open = self.count(inode.__dict__.get('open', builtins.open))
+        if (self.allocations and tracemalloc is not None and
+                not tracemalloc.is_tracing()):
+            tracemalloc.start()
+            self._tracemalloc_started = True
+        if self.cprofile is not None:
+            self.cprofile.enable()
+
+    def disable(self):
+        """
+        Restores the hot paths.
+        """
+        if self.cprofile is not None:
+            self.cprofile.disable()
+        if self._tracemalloc_started:
+            tracemalloc.stop()
+            self._tracemalloc_started = False
+        while self._originals:
+            obj, attribute, value = self._originals.pop()
+            if value is None:
+                delattr(obj, attribute)
+            else:
+                setattr(obj, attribute, value)
+
+    def report(self):
+        """
+        Returns a string with one line for each phase.
+        """
+        return '\n'.join(repr(phase) for phase in
+                         sorted(self.phases.values(),
+                                key=lambda phase: phase.wall_time,
+                                reverse=True))
+
+    def dump_report(self, path):
+        """
+        Saves the report in a file.
+        """
+        with open(path, 'w') as f:
+            f.write(self.report() + '\n')
+
+    def dump_stats(self, path):
+        """
+        Saves the cProfile profile in a file in the pstats format.
+
+        Raises ValueError, if the profiler was created without cprofile.
+        """
+        if self.cprofile is None:
+            raise ValueError("The profiler was created without cprofile")
+        self.cprofile.dump_stats(path)
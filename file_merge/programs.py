@@ -1,5 +1,15 @@
+import collections
+import multiprocessing
 import os
-from .inode import INodeFile, INodeFileList
+import queue
+from .dircache import DirectoryCache
+from .estimate import estimate_savings
+from .index import ContentIndex
+from .inode import INodeFile, INodeFileList, colliding_sizes
+from .scheduler import MergeScheduler
+from .spill import SpillScanner
+from .tree import DirectoryTree
+from .utils import verbose, ERROR, INFO
 
 
 def p1(base_path):
@@ -13,7 +23,7 @@ def p1(base_path):
         inode_file_list = INodeFileList(full_path)
         verbose("Start merging", INFO)
         merged_files = inode_file_list.merge()
-        verbose("Merged %d files" % len(merged_files), INFO)
+        verbose("Merged %d files, freed %d bytes" % (len(merged_files), merged_files.size()), INFO)
         inode_file_list.dump(files_path)
 
 
@@ -46,7 +56,50 @@ def p2(base_path):
             f.write(path)
 
 
-def p3(base_path):
+def scan_snapshot(full_path, cache_path=None, memory_budget=None):
+    """
+    Scans one snapshot and dumps its files.
+
+    If 'cache_path' is set, a DirectoryCache is loaded from and saved to it.
+
+    If 'memory_budget' is set, the snapshot is scanned with a SpillScanner
+    within that many bytes. The DirectoryCache is not used then.
+
+    Returns the path and the number of files.
+    """
+    files_path = os.path.join(full_path, 'files')
+    if memory_budget is not None:
+        return full_path, SpillScanner(full_path, memory_budget).dump(files_path)
+    cache = DirectoryCache(cache_path) if cache_path is not None else None
+    inode_file_list = INodeFileList(full_path, cache=cache)
+    if os.path.exists(files_path):
+        # Do not index an old dump.
+        dump_inode = os.lstat(files_path).st_ino
+        if dump_inode in inode_file_list.storage:
+            del inode_file_list[dump_inode]
+    inode_file_list.dump(files_path)
+    if cache is not None:
+        cache.dump()
+    return full_path, len(inode_file_list)
+
+
+def p3(base_path, processes=1, walks_per_device=1, rescan=False,
+       memory_budget=None):
+    """
+    Scans each numbered snapshot and dumps its files into <n>/files.
+
+    If 'processes' is bigger then one, the snapshots are scanned in that many
+    worker processes. Only 'walks_per_device' snapshots on the same device
+    are scanned at the same time.
+
+    If 'rescan' is True, the snapshots that were already scanned are scanned
+    again. A DirectoryCache for each snapshot is saved in <n>.dircache, so
+    unchanged directories are not listed again.
+
+    If 'memory_budget' is set, each snapshot is scanned within that many
+    bytes, see SpillScanner. It can not be used together with 'rescan'.
+    """
+    snapshots = []
     for path in sorted(os.listdir(base_path)):
         try:
             int(path)
@@ -54,29 +107,191 @@ def p3(base_path):
             continue
         full_path = os.path.join(base_path, path)
         files_path = os.path.join(full_path, 'files')
-        if os.path.exists(files_path):
+        if os.path.exists(files_path) and not rescan:
             verbose("Skipping %s" % full_path, INFO)
             continue
+        cache_path = full_path + '.dircache' if rescan else None
+        snapshots.append((full_path, cache_path))
+
+    if processes > 1:
+        scan_snapshots_parallel(snapshots, processes, walks_per_device,
+                                memory_budget)
+        return
+
+    for full_path, cache_path in snapshots:
         verbose("Now I do %s" % full_path, INFO)
-        inode_file_list = INodeFileList(full_path)
-        inode_file_list.dump(files_path)
-        verbose("files: %d" % len(inode_file_list))
+        verbose("files: %d" % scan_snapshot(full_path, cache_path, memory_budget)[1])
 
 
-def p3b(base_path):
-    file_list = INodeFileList()
+def scan_snapshots_parallel(snapshots, processes, walks_per_device,
+                            memory_budget=None):
+    """
+    Scans the snapshots in worker processes.
+
+    The worker processes dump the files of each snapshot themselves. The main
+    process starts the scans and reports the progress.
+    """
+    waiting = {}
+    for full_path, cache_path in snapshots:
+        device = os.stat(full_path).st_dev
+        waiting.setdefault(device, collections.deque()).append((full_path, cache_path))
+    running = dict.fromkeys(waiting, 0)
+    finished = queue.Queue()
+
+    def start(pool):
+        for device, paths in waiting.items():
+            while paths and running[device] < walks_per_device:
+                full_path, cache_path = paths.popleft()
+                running[device] += 1
+                pool.apply_async(
+                    scan_snapshot, (full_path, cache_path, memory_budget),
+                    callback=lambda result, device=device: finished.put((device, result, None)),
+                    error_callback=lambda error, device=device, full_path=full_path: finished.put(
+                        (device, (full_path, 0), error)))
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        start(pool)
+        files = 0
+        for done in range(1, len(snapshots) + 1):
+            device, (full_path, count), error = finished.get()
+            running[device] -= 1
+            if error is not None:
+                verbose("Can not scan %s: %s" % (full_path, error), ERROR)
+            files += count
+            verbose("%d/%d snapshots, %d files: %s" % (done, len(snapshots), files, full_path), INFO)
+            start(pool)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_snapshots(base_path):
+    """
+    Loads the files dumped by p3 from each numbered snapshot.
+
+    Only the files, whose size collides with an other inode, are loaded. All
+    other files can not be merged.
+    """
+    files_paths = []
     for path in sorted(os.listdir(base_path)):
         try:
             int(path)
         except ValueError:
             continue
-        full_path = os.path.join(base_path, path)
-        files_path = os.path.join(full_path, 'files')
+        files_paths.append(os.path.join(base_path, path, 'files'))
+
+    verbose("Counting sizes")
+    sizes = colliding_sizes(files_paths)
+    file_list = INodeFileList()
+    for files_path in files_paths:
         verbose("Loading %s" % files_path)
-        file_list.load(files_path)
+        file_list.load(files_path, sizes)
+    return file_list
+
+
+def p3b(base_path, time_budget=None, io_budget=None):
+    file_list = load_snapshots(base_path)
 
     #verbose("dumping file")
     #file_list.dump(os.path.join(base_path, path + '.all-data'))
     verbose("merging files")
-    file_list.merge()
-    verbose("%d Files merged", len(file_list))
+    scheduler = MergeScheduler(file_list, time_budget, io_budget,
+                               os.path.join(base_path, 'file_merge.schedule'))
+    merged_files = scheduler.run()
+    verbose("%d Files merged" % len(merged_files))
+    if not scheduler.finished:
+        verbose("Budget exhausted, the next run continues", INFO)
+
+
+def p3e(base_path):
+    """
+    Estimates the bytes p3b would reclaim without reading all files.
+    """
+    file_list = load_snapshots(base_path)
+    verbose("estimating savings")
+    verbose("%s reclaimable" % estimate_savings(file_list), INFO)
+
+
+def p4(base_path):
+    """
+    Merges each new numbered snapshot against a persistent content index.
+
+    Only the files from the new snapshots are scanned and hashed.
+    """
+    index_file = os.path.join(base_path, 'file_merge.index')
+    status_file = os.path.join(base_path, 'file_merge.index-status')
+    if os.path.exists(status_file):
+        with open(status_file) as f:
+            last_path = int(f.readline().strip())
+    else:
+        last_path = 0
+    index = ContentIndex(index_file)
+
+    for path in sorted(os.listdir(base_path), key=lambda path: path.zfill(20)):
+        try:
+            int(path)
+        except ValueError:
+            continue
+        if int(path) <= last_path:
+            continue
+
+        full_path = os.path.join(base_path, path)
+        verbose("Now I do %s" % full_path, INFO)
+        inode_file_list = INodeFileList(full_path)
+        merged_files = index.merge(inode_file_list)
+        verbose("Merged %d files, %d files in index" % (len(merged_files), len(index)), INFO)
+        index.dump()
+        with open(status_file, 'w') as f:
+            f.write(path)
+
+
+def p5(base_path):
+    """
+    Merges identical subtrees below base_path as a whole and then the
+    remaining files one by one.
+    """
+    tree = DirectoryTree(base_path)
+    for directories in tree.duplicates():
+        verbose("Identical: %s" % ", ".join(directories), INFO)
+    merged_files = tree.merge()
+    verbose("Merged %d files in identical subtrees" % len(merged_files), INFO)
+    merged_files = tree.inode_files.merge()
+    verbose("Merged %d other files" % len(merged_files), INFO)
+
+
+def p6(base_path, memory_budget=64 * 1024 * 1024):
+    """
+    Merges each numbered snapshot like p1, but keeps only the files with a
+    colliding size in memory.
+
+    After the merge, the snapshot is scanned again to dump its files into
+    <n>/files with the new inodes.
+    """
+    for path in sorted(os.listdir(base_path)):
+        try:
+            int(path)
+        except ValueError:
+            continue
+        full_path = os.path.join(base_path, path)
+        files_path = os.path.join(full_path, 'files')
+        if os.path.exists(files_path):
+            verbose("Skipping %s" % full_path, INFO)
+            continue
+        verbose("Now I do %s" % full_path, INFO)
+        inode_file_list = SpillScanner(full_path, memory_budget).candidates()
+        verbose("Start merging %d candidates" % len(inode_file_list), INFO)
+        merged_files = inode_file_list.merge()
+        verbose("Merged %d files, freed %d bytes" % (len(merged_files), merged_files.size()), INFO)
+        SpillScanner(full_path, memory_budget).dump(files_path)
+
+
+def p7(base_path, hashers=4):
+    """
+    Scans and merges base_path in overlapping stages, see Pipeline.
+    """
+    # The pipeline needs Python 3.7, so it is only imported when it is used.
+    from .pipeline import Pipeline
+    pipeline = Pipeline(base_path, hashers=hashers)
+    merged_files = pipeline.run()
+    verbose("Merged %d files, freed %d bytes" % (len(merged_files), merged_files.size()), INFO)
@@ -0,0 +1,160 @@
+import os
+import time
+
+from .inode import INodeFile, INodeFileList, SMALL_FILE_LIMIT
+from .utils import verbose, INFO, DEBUG
+
+
+class MergeScheduler(object):
+    """
+    Merges the INodeFiles of an INodeFileList ordered by the expected savings.
+
+    Each group of INodeFiles with the same size is ranked by the bytes it could
+    reclaim per byte that has to be read to confirm the duplicates. The groups
+    are merged in that order until a time budget is exhausted. Groups that do
+    not fit into the rest of an io budget are skipped, but the first group of
+    a run is always merged, so a group that is bigger than the whole budget
+    does not block the next runs. The sizes that were already merged can be
+    saved in a state file, so the next run continues where the last one
+    stopped.
+    """
+    def __init__(self, inode_file_list, time_budget=None, io_budget=None,
+                 state=None):
+        """
+        'inode_file_list' is the INodeFileList to merge.
+
+        'time_budget' is the number of seconds after which no new group is
+        started.
+
+        'io_budget' is the number of bytes that may be read to hash files.
+
+        'state' is the path to a file where the merged sizes are saved.
+        """
+        self.inode_file_list = inode_file_list
+        self.time_budget = time_budget
+        self.io_budget = io_budget
+        self.state = state
+        self.done = set()
+        self.finished = False
+        if state is not None and os.path.exists(state):
+            with open(state) as f:
+                self.done = set(int(line) for line in f if line.strip())
+
+    @staticmethod
+    def expected_savings(size_list):
+        """
+        Returns the bytes that are reclaimed, if all INodeFiles in 'size_list'
+        are identical.
+        """
+        return size_list.reclaimable_size()
+
+    @staticmethod
+    def expected_cost(size_list):
+        """
+        Returns the bytes that have to be read to confirm the INodeFiles in
+        'size_list'.
+
+        Each file is read for the prefix_md5sum, the md5sum and the sha1sum.
+        Small files are read only once.
+        """
+        size = size_list.value_for_index(0).size
+        if size <= SMALL_FILE_LIMIT:
+            return len(size_list) * size
+        return len(size_list) * (min(size, 1280) + 2 * size)
+
+    def priority(self, size_list):
+        """
+        Returns a sort key. Groups with a bigger key are merged first.
+        """
+        savings = self.expected_savings(size_list)
+        return (float(savings) / max(self.expected_cost(size_list), 1), savings)
+
+    def candidates(self):
+        """
+        Returns the groups of INodeFiles with the same size, that are not
+        merged yet, ordered by their priority.
+        """
+        if not len(self.inode_file_list):
+            return []
+        size_lists = [size_list for size_list
+                      in self.inode_file_list.iter_list('size')
+                      if size_list.value_for_index(0).size not in self.done]
+        size_lists.sort(key=self.priority, reverse=True)
+        return size_lists
+
+    def exhausted(self, start_time):
+        """
+        Returns True if the time budget is exhausted.
+        """
+        return (self.time_budget is not None and
+                time.time() - start_time >= self.time_budget)
+
+    def fits(self, start_bytes, size_list):
+        """
+        Returns True if the io budget that is left is enough to merge
+        'size_list'.
+        """
+        if self.io_budget is None:
+            return True
+        bytes_read = INodeFile.bytes_read - start_bytes
+        return bytes_read + self.expected_cost(size_list) <= self.io_budget
+
+    def run(self):
+        """
+        Merge the groups until the budget is exhausted.
+
+        The progress is saved after each group, so a killed run continues
+        with the first group that was not merged completely.
+
+        Returns an INodeFileList with the merged INodeFiles.
+        """
+        start_time = time.time()
+        start_bytes = INodeFile.bytes_read
+        merged_items = INodeFileList()
+        merged_groups = 0
+        self.finished = True
+        for size_list in self.candidates():
+            if self.exhausted(start_time):
+                verbose("Time budget exhausted", INFO)
+                self.finished = False
+                break
+            size = size_list.value_for_index(0).size
+            if merged_groups and not self.fits(start_bytes, size_list):
+                verbose("%s does not fit into the io budget" % size, DEBUG)
+                self.finished = False
+                continue
+            verbose("%s, %d files" % (size, len(size_list)), DEBUG)
+            merged_items.add(size_list.merge_size_list())
+            merged_groups += 1
+            self.done.add(size)
+            self.record(size)
+
+        del self.inode_file_list[merged_items]
+        self.save()
+        return merged_items
+
+    def record(self, size):
+        """
+        Appends a merged size to the state file.
+        """
+        if self.state is None:
+            return
+        with open(self.state, 'a') as f:
+            f.write('%d\n' % size)
+
+    def save(self):
+        """
+        Saves the merged sizes in the state file.
+
+        When all groups are merged, the state file is removed, so the next run
+        starts from the beginning.
+        """
+        if self.state is None:
+            return
+        if self.finished:
+            if os.path.exists(self.state):
+                os.remove(self.state)
+            return
+        with open(self.state, 'w') as f:
+            for size in sorted(self.done):
+                f.write('%d\n' % size)
@@ -0,0 +1,178 @@
+import functools
+import heapq
+import itertools
+import os
+import stat
+import tempfile
+
+from .inode import INodeFile, INodeFileList
+from .utils import verbose, WARNING, DEBUG
+
+# The estimated memory of one record in the scan buffer in bytes.
+RECORD_SIZE = 256
+
+# The size of the blocks that are read from a run file.
+BLOCK_SIZE = 64 * 1024
+
+
+class SpillScanner(object):
+    """
+    Scans a directory within a memory budget.
+
+    Only a (size, inode, path) record is kept for each file. When the
+    records exceed the memory budget, they are sorted and written to a run
+    file. At the end the runs are merged by size and only the files whose
+    size collides with another inode become INodeFiles, or all files are
+    dumped in the format of INodeFileList.dump.
+
+    Like INodeFileList, the files are identified by their inode, so files on
+    other devices then the directory are skipped.
+
+    A run file is a binary file with three null terminated fields for each
+    record. The path is encoded with os.fsencode, so any path can be saved.
+    The run files are created with tempfile and removed at once, so they do
+    not stay behind, even if the process is killed.
+
+    Attributes
+    ----------
+    directory: the path to scan
+    memory_budget: the memory for the records in bytes
+    tmpdir: the directory for the run files
+    runs: the open run files
+    """
+    def __init__(self, directory, memory_budget=64 * 1024 * 1024, tmpdir=None):
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.tmpdir = tmpdir or tempfile.gettempdir()
+        self.runs = []
+        self.buffer = []
+
+    def __repr__(self):
+        return "%d records in memory, %d runs" % (len(self.buffer), len(self.runs))
+
+    def scan(self):
+        """
+        Reads all files below the directory, that are on its device.
+        """
+        device = os.lstat(self.directory).st_dev
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    file_stat = os.lstat(path)
+                except OSError:
+                    verbose("File not found: %s" % path, DEBUG)
+                    continue
+                if not stat.S_ISREG(file_stat.st_mode):
+                    continue
+                if file_stat.st_dev != device:
+                    verbose("Other device: %s" % path, DEBUG)
+                    continue
+                self.buffer.append((file_stat.st_size, file_stat.st_ino, path))
+                if len(self.buffer) * RECORD_SIZE >= self.memory_budget:
+                    self.spill()
+
+    def spill(self):
+        """
+        Writes the sorted records from the buffer into a new run file.
+        """
+        self.buffer.sort()
+        run = tempfile.TemporaryFile(prefix='file_merge-', suffix='.run',
+                                     dir=self.tmpdir)
+        self.runs.append(run)
+        for size, inode, path in self.buffer:
+            run.write(('%d\0%d\0' % (size, inode)).encode('ascii') +
+                      os.fsencode(path) + b'\0')
+        verbose("Spilled %d records to run %d" % (len(self.buffer), len(self.runs)),
+                DEBUG)
+        self.buffer = []
+
+    @staticmethod
+    def read_fields(run):
+        """
+        Yields the null terminated fields from a run file.
+        """
+        run.seek(0)
+        rest = b''
+        for block in iter(functools.partial(run.read, BLOCK_SIZE), b''):
+            fields = (rest + block).split(b'\0')
+            rest = fields.pop()
+            for field in fields:
+                yield field
+
+    def read_run(self, run):
+        """
+        Yields the records from a run file.
+        """
+        fields = self.read_fields(run)
+        for size, inode, path in zip(fields, fields, fields):
+            yield int(size), int(inode), os.fsdecode(path)
+
+    def records(self):
+        """
+        Yields all records ordered by size, inode and path.
+        """
+        self.buffer.sort()
+        runs = [self.read_run(run) for run in self.runs]
+        return heapq.merge(self.buffer, *runs)
+
+    def candidates(self):
+        """
+        Scans the directory and returns an INodeFileList with the files,
+        whose size collides with a file with an other inode.
+
+        The run files are removed afterwards.
+        """
+        inode_file_list = INodeFileList()
+        try:
+            self.scan()
+            for size, records in itertools.groupby(self.records(),
+                                                   key=lambda record: record[0]):
+                records = list(records)
+                if records[0][1] == records[-1][1]:
+                    # All files have the same inode.
+                    continue
+                for size, inode, path in records:
+                    inode_file_list.add(INodeFile('%d\0%d\0\0\0\0%s' % (inode, size, path)))
+        finally:
+            self.cleanup()
+        return inode_file_list
+
+    def dump(self, path):
+        """
+        Scans the directory and saves all files in 'path' in the format of
+        INodeFileList.dump. The file at 'path' is not saved itself. Paths
+        with a newline can not be saved in this format and are skipped.
+
+        Only the records of one inode are held in memory while the runs are
+        merged. The run files are removed afterwards.
+
+        Returns the number of saved inodes.
+        """
+        count = 0
+        try:
+            self.scan()
+            with open(path, 'w') as f:
+                for (size, inode), records in itertools.groupby(
+                        self.records(), key=lambda record: record[:2]):
+                    paths = []
+                    for record in records:
+                        if '\n' in record[2]:
+                            verbose("Can not dump %r" % record[2], WARNING)
+                        elif record[2] != path:
+                            paths.append(record[2])
+                    if paths:
+                        f.write('%d\0%d\0\0\0\0%s\n' % (inode, size, '\0'.join(paths)))
+                        count += 1
+        finally:
+            self.cleanup()
+        return count
+
+    def cleanup(self):
+        """
+        Closes the run files and clears the buffer.
+        """
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.buffer = []
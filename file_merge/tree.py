@@ -0,0 +1,189 @@
+import hashlib
+import os
+import stat
+
+from .inode import INodeFile, INodeFileList
+from .utils import verbose, INFO, DEBUG
+
+
+class DirectoryTree(object):
+    """
+    The directories below a path with a Merkle digest for each directory.
+
+    The digest of a directory is built from the names and digests of its
+    files and subdirectories, so two directories with the same digest contain
+    identical subtrees. Such subtrees are merged as a whole.
+
+    To find candidates without reading files, a shape digest is built from
+    the names and sizes first. Only the files in directories with a colliding
+    shape are hashed.
+
+    Attributes
+    ----------
+    directory: the path that was scanned
+    inode_files: an INodeFileList with all files below the directory
+    entries: a dict that maps each directory to a dict of its files (name to
+             INodeFile) and a list of the names of its subdirectories
+    shapes: a dict that maps each directory to its shape digest. It is None
+            for directories that contain other files then regular files and
+            directories.
+    """
+    def __init__(self, directory):
+        """
+        'directory' has to be a path to a directory. It is scanned at once.
+        """
+        self.directory = directory
+        self.inode_files = INodeFileList()
+        self.entries = {}
+        self.shapes = {}
+        self.file_counts = {}
+        self._digests = {}
+        self.scan()
+
+    def __repr__(self):
+        return "%d directories" % len(self.entries)
+
+    def scan(self):
+        """
+        Reads the directories bottom up and builds their shape digests.
+        """
+        for root, dirs, files in os.walk(self.directory, topdown=False):
+            inode_files = {}
+            lines = []
+            hashable = True
+            file_count = 0
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    mode = os.lstat(path).st_mode
+                except OSError:
+                    verbose("File not found: %s" % path, DEBUG)
+                    hashable = False
+                    continue
+                if not stat.S_ISREG(mode):
+                    hashable = False
+                    continue
+                item = INodeFile(path)
+                self.inode_files.add(item)
+                inode_files[name] = self.inode_files[item]
+                lines.append('F\0%s\0%d' % (name, item.size))
+                file_count += 1
+
+            for name in dirs:
+                path = os.path.join(root, name)
+                shape = self.shapes.get(path)
+                if shape is None:
+                    # A symlink to a directory or an unhashable directory.
+                    hashable = False
+                    continue
+                lines.append('D\0%s\0%s' % (name, shape))
+                file_count += self.file_counts[path]
+
+            self.entries[root] = (inode_files, dirs)
+            self.file_counts[root] = file_count
+            self.shapes[root] = self.build_digest(lines) if hashable else None
+
+    @staticmethod
+    def build_digest(lines):
+        """
+        Returns the sha1sum of the sorted lines.
+        """
+        algo = hashlib.sha1()
+        for line in sorted(lines):
+            algo.update(line.encode('utf-8', 'replace') + b'\n')
+        return algo.hexdigest()
+
+    def digest(self, directory):
+        """
+        Returns the Merkle digest of the content of 'directory'.
+
+        The digest is built from the names and sha1sums of the files and the
+        names and digests of the subdirectories.
+        """
+        try:
+            return self._digests[directory]
+        except KeyError:
+            pass
+        inode_files, dirs = self.entries[directory]
+        lines = ['F\0%s\0%s' % (name, item.sha1sum)
+                 for name, item in inode_files.items()]
+        lines.extend('D\0%s\0%s' % (name, self.digest(os.path.join(directory, name)))
+                     for name in dirs)
+        self._digests[directory] = self.build_digest(lines)
+        return self._digests[directory]
+
+    def files(self, directory, prefix=''):
+        """
+        Yields the relative path and the INodeFile of each file below
+        'directory'.
+        """
+        inode_files, dirs = self.entries[directory]
+        for name in sorted(inode_files):
+            yield os.path.join(prefix, name), inode_files[name]
+        for name in sorted(dirs):
+            for item in self.files(os.path.join(directory, name),
+                                   os.path.join(prefix, name)):
+                yield item
+
+    def duplicates(self):
+        """
+        Returns the groups of identical subtrees as sorted lists of paths.
+
+        A group is not returned, if all its directories are inside of
+        identical parent directories.
+        """
+        shape_groups = {}
+        for directory, shape in self.shapes.items():
+            if shape is not None and self.file_counts[directory]:
+                shape_groups.setdefault(shape, []).append(directory)
+
+        digest_groups = {}
+        for directories in shape_groups.values():
+            if len(directories) < 2:
+                continue
+            for directory in directories:
+                digest_groups.setdefault(self.digest(directory), []).append(directory)
+
+        duplicated = set()
+        for directories in digest_groups.values():
+            if len(directories) > 1:
+                duplicated.update(directories)
+
+        groups = []
+        for directories in digest_groups.values():
+            if len(directories) < 2:
+                continue
+            if all(os.path.dirname(directory) in duplicated
+                   for directory in directories):
+                continue
+            groups.append(sorted(directories))
+        groups.sort()
+        return groups
+
+    def merge(self, demo=False):
+        """
+        Merges each group of identical subtrees into its first directory.
+
+        The files of a subtree are merged as one operation by their relative
+        paths. If 'demo' is True, the subtrees are found but not merged.
+
+        Returns an INodeFileList with the merged INodeFiles. They are removed
+        from the attribute inode_files, so the remaining files can be merged
+        with INodeFileList.merge.
+        """
+        merged_items = INodeFileList()
+        for directories in self.duplicates():
+            base = directories[0]
+            verbose("Merge %d copies of %s" % (len(directories) - 1, base), INFO)
+            base_files = list(self.files(base))
+            for directory in directories[1:]:
+                for (path, base_item), (other_path, item) in zip(base_files, self.files(directory)):
+                    if (item.inode == base_item.inode or
+                            item.merged_into is not None or
+                            not item.complete):
+                        continue
+                    if demo or base_item.merge(item):
+                        merged_items.add(item)
+        if not demo:
+            del self.inode_files[merged_items]
+        return merged_items
@@ -1,6 +1,26 @@
+import collections
+import multiprocessing
+import queue
 import unittest
 import fake_filesystem
 import file_merge.inode
+import file_merge.dircache
+import file_merge.estimate
+import file_merge.index
+import file_merge.profiling
+import file_merge.programs
+import file_merge.spill
+import file_merge.tree
+import file_merge.scheduler
+
+# The pipeline needs Python 3.7 or newer.
+try:
+    import asyncio
+    import file_merge.pipeline
+except (ImportError, SyntaxError):
+    pipeline = None
+else:
+    pipeline = file_merge.pipeline
 
 # Do not print anything.
 file_merge.utils.VERBOSE_LEVEL = 0
@@ -14,18 +34,40 @@ open = fake_filesystem.FakeFileOpen(filesystem)
 
 # fake_filesystem does not implement os.link yet
 def link(source, link):
-    inode = os.stat(source).st_ino
-    filesystem.CreateFile(link, contents='', inode=inode)
+    source_stat = os.stat(source)
+    filesystem.CreateFile(link, contents='', inode=source_stat.st_ino)
+    filesystem.GetObject(link).st_dev = source_stat.st_dev
 
 os.link = link
 
 # Override the namespace from the file_merge module
 file_merge.inode.os = os
 file_merge.inode.open = open
+file_merge.index.os = os
+file_merge.tree.os = os
+file_merge.dircache.os = os
+file_merge.dircache.open = open
+file_merge.spill.os = os
+file_merge.spill.open = open
+file_merge.scheduler.os = os
+file_merge.scheduler.open = open
+file_merge.programs.os = os
+file_merge.programs.open = open
+if pipeline is not None:
+    pipeline.os = os
 
 # Load the INodeFile name into the global namespace for easier use
 INodeFile = file_merge.inode.INodeFile
 INodeFileList = file_merge.inode.INodeFileList
+colliding_sizes = file_merge.inode.colliding_sizes
+ContentIndex = file_merge.index.ContentIndex
+estimate_savings = file_merge.estimate.estimate_savings
+Profiler = file_merge.profiling.Profiler
+Pipeline = pipeline and pipeline.Pipeline
+DirectoryTree = file_merge.tree.DirectoryTree
+SpillScanner = file_merge.spill.SpillScanner
+DirectoryCache = file_merge.dircache.DirectoryCache
+MergeScheduler = file_merge.scheduler.MergeScheduler
 
 
 class TestCase(unittest.TestCase):
@@ -90,6 +132,7 @@ class TestINodeFile(TestCase):
         value = self.inode_file.addfile(INodeFile('/other'))
         self.assertFalse(value)
         self.assertNotIn('/other', self.inode_file)
+        self.assertIsNone(getattr(self.inode_file, '_prefix_md5sum', None))
 
         value = self.inode_file.addfile('/other')
         self.assertFalse(value)
@@ -121,6 +164,11 @@ class TestINodeFileHash(TestCase):
         self.assertEqual(self.smaler_file.sha1sum, 'a9ecf1681e9dea399f2f32968fe941f669bb062b')
         self.assertIsNotNone(getattr(self.big_file, '_sha1sum', None))
 
+    def test_sample_md5sum(self):
+        self.assertEqual(self.smaler_file.sample_md5sum, self.smaler_file.prefix_md5sum)
+        self.assertNotEqual(self.big_file.sample_md5sum, self.big_file.prefix_md5sum)
+        self.assertIsNotNone(getattr(self.big_file, '_sample_md5sum', None))
+
 
 class TestINodeFileDump(TestCase):
     def setUp(self):
@@ -165,23 +213,30 @@ class TestINodeFileCompare(TestCase):
 
     def test_compare(self):
         self.assertEqual(self.files[1], self.files[2])
+        self.assertNotEqual(self.files[0], self.files[1])
+        self.assertNotEqual(self.files[4], self.files[5])
+        for inode_file in self.files:
+            self.assertIsNone(getattr(inode_file, '_prefix_md5sum', None))
+
+    def test_same_content(self):
+        self.assertTrue(self.files[1].same_content(self.files[2]))
         self.assertIsNone(getattr(self.files[1], '_prefix_md5sum', None))
 
-        self.assertNotEqual(self.files[0], self.files[2])
+        self.assertFalse(self.files[0].same_content(self.files[2]))
         self.assertIsNone(getattr(self.files[1], '_prefix_md5sum', None))
 
-        self.assertNotEqual(self.files[0], self.files[1])
+        self.assertFalse(self.files[0].same_content(self.files[1]))
         self.assertIsNotNone(getattr(self.files[1], '_prefix_md5sum', None))
 
-        self.assertNotEqual(self.files[3], self.files[4])
+        self.assertFalse(self.files[3].same_content(self.files[4]))
         self.assertIsNotNone(getattr(self.files[3], '_md5sum', None))
 
         self.files[5]._sha1sum = 'different'
-        self.assertNotEqual(self.files[4], self.files[5])
+        self.assertFalse(self.files[4].same_content(self.files[5]))
         self.assertIsNotNone(getattr(self.files[4], '_sha1sum', None))
 
         del self.files[5]._sha1sum
-        self.assertEqual(self.files[4], self.files[5])
+        self.assertTrue(self.files[4].same_content(self.files[5]))
 
 
 class TestINodeFileMerge(TestCase):
@@ -193,10 +248,122 @@ class TestINodeFileMerge(TestCase):
 
     def test_merge(self):
         self.assertNotEqual(self.f1.inode, self.f2.inode)
-        self.f1.merge(self.f2)
+        self.assertTrue(self.f1.merge(self.f2))
         self.assertIn('/path2', self.f1)
         self.assertEqual(repr(self.f2), 'merged into %s' % self.f1)
 
+    def test_merge_link_fails(self):
+        def link(source, path):
+            raise OSError('link failed')
+        original_link = os.link
+        os.link = link
+        try:
+            self.assertFalse(self.f1.merge(self.f2))
+        finally:
+            os.link = original_link
+        self.assertTrue(os.path.exists('/path2'))
+        self.assertFalse(os.path.exists('/path2.file_merge-bu'))
+        self.assertNotIn('/path2', self.f1)
+
+    def test_merge_list_link_fails(self):
+        def link(source, path):
+            raise OSError('link failed')
+        original_link = os.link
+        os.link = link
+        inode_file_list = INodeFileList()
+        inode_file_list.add(self.f1)
+        inode_file_list.add(self.f2)
+        try:
+            merged = inode_file_list.merge()
+        finally:
+            os.link = original_link
+        self.assertEqual(len(merged), 0)
+        self.assertEqual(merged.size(), 0)
+        self.assertEqual(len(inode_file_list), 2)
+
+
+class TestINodeFileNLink(TestCase):
+    def setUp(self):
+        self.add_file('/path1', 'content', 5)
+        self.add_file('/path2', 'content', 5)
+        self.f1 = INodeFile('/path1')
+
+    def test_nlink(self):
+        self.assertEqual(self.f1.nlink, 1)
+        self.assertTrue(self.f1.complete)
+
+    def test_incomplete(self):
+        self.f1._nlink = 2
+        self.assertFalse(self.f1.complete)
+        self.f1.addfile('/path2')
+        self.assertTrue(self.f1.complete)
+
+
+class TestINodeFileListMergeTarget(TestCase):
+    def setUp(self):
+        self.add_file('/t/one', 'content', 10)
+        self.add_file('/t/two1', 'content', 11)
+        self.add_file('/t/two2', 'content', 11)
+        self.add_file('/t/outside', 'content', 12)
+        self.ilist = INodeFileList('/t')
+
+    def test_pop_merge_target(self):
+        target = self.ilist.pop_merge_target()
+        self.assertEqual(target.inode, 11)
+        self.assertEqual(len(self.ilist), 2)
+
+    def test_pop_merge_target_outside_links(self):
+        self.ilist[12]._nlink = 3
+        self.assertEqual(self.ilist.pop_merge_target().inode, 12)
+
+    def test_reclaimable_size(self):
+        self.assertEqual(self.ilist.reclaimable_size(), 14)
+        self.ilist[12]._nlink = 3
+        self.assertEqual(self.ilist.reclaimable_size(), 14)
+        self.ilist[10]._nlink = 3
+        self.assertEqual(self.ilist.reclaimable_size(), 7)
+
+    def test_merge_skips_outside_links(self):
+        self.ilist[12]._nlink = 3
+        self.ilist[10]._nlink = 3
+        merged = self.ilist.merge()
+        self.assertEqual([item.inode for item in merged], [11])
+        self.assertIn(os.lstat('/t/two1').st_ino, (10, 12))
+        self.assertEqual(os.lstat('/t/one').st_ino, 10)
+        self.assertEqual(os.lstat('/t/outside').st_ino, 12)
+
+
+class TestINodeFileListSmallFiles(TestCase):
+    def setUp(self):
+        self.add_file('/small/a1', 'aaaa', 30)
+        self.add_file('/small/b1', 'bbbb', 31)
+        self.add_file('/small/a2', 'aaaa', 32)
+        self.add_file('/small/b2', 'bbbb', 33)
+        self.add_file('/small/big1', 2000 * 'l', 34)
+        self.add_file('/small/big2', 2000 * 'l', 35)
+        self.ilist = INodeFileList('/small')
+
+    def test_read_hashes(self):
+        item = self.ilist[34]
+        item.read_hashes()
+        other = self.ilist[35]
+        self.assertEqual((item.prefix_md5sum, item.md5sum, item.sha1sum),
+                         (other.prefix_md5sum, other.md5sum, other.sha1sum))
+
+    def test_merge_small_files(self):
+        bytes_read = INodeFile.bytes_read
+        merged = self.ilist.merge(small_file_limit=2000)
+        self.assertEqual(sorted(item.inode for item in merged), [32, 33, 35])
+        self.assertEqual(INodeFile.bytes_read - bytes_read, 4 * 4 + 2 * 2000)
+        self.assertEqual(os.lstat('/small/a2').st_ino, 30)
+        self.assertEqual(os.lstat('/small/b2').st_ino, 31)
+
+    def test_merge_big_files(self):
+        bytes_read = INodeFile.bytes_read
+        merged = self.ilist.merge(small_file_limit=4)
+        self.assertEqual(len(merged), 3)
+        self.assertEqual(INodeFile.bytes_read - bytes_read, 4 * 4 + 2 * (1280 + 2000 + 2000))
+
 
 class TestINodeFileList(TestCase):
     def setUp(self):
@@ -269,6 +436,33 @@ class TestINodeFileList(TestCase):
         ilist = INodeFileList(load='/dumpfile')
         self.assertEqual(ilist.storage, self.ilist.storage)
 
+    def test_load_sizes(self):
+        self.add_file('/dumpfile', '')
+        self.add_file('/dumpfile2', '')
+        self.add_file('/other/path1', 'content')
+        self.ilist.dump('/dumpfile')
+        INodeFileList('/other').dump('/dumpfile2')
+        sizes = colliding_sizes(['/dumpfile', '/dumpfile2'])
+        self.assertEqual(sizes, set([7]))
+
+        ilist = INodeFileList()
+        ilist.load('/dumpfile', sizes)
+        ilist.load('/dumpfile2', sizes)
+        self.assertEqual(repr(ilist.storage), '{1: [/path1], %d: [/other/path1]}' % os.lstat('/other/path1').st_ino)
+
+    def test_colliding_sizes_hardlinks(self):
+        self.add_file('/dumpfile', '')
+        self.add_file('/dumpfile2', '')
+        self.add_file('/other/link', 'content', 1)
+        self.ilist.dump('/dumpfile')
+        INodeFileList('/other').dump('/dumpfile2')
+        self.assertEqual(colliding_sizes(['/dumpfile', '/dumpfile2']), set())
+
+        ilist = INodeFileList(load='/dumpfile')
+        ilist.load('/dumpfile2')
+        self.assertEqual(len(ilist), 4)
+        self.assertEqual(ilist[1].files, set(['/path1', '/other/link']))
+
     def test_add_inode_file(self):
         self.add_file('/new_file', 'foobar', 500)
         self.add_file('/new_file2', 'foobar', 500)
@@ -314,5 +508,570 @@ class TestINodeFileList(TestCase):
         self.assertEqual(len(self.ilist), 3)
 
 
+class TestContentIndex(TestCase):
+    def setUp(self):
+        self.add_file('/1/file', 'content')
+        self.add_file('/1/other', 'other content')
+        self.add_file('/2/file', 'content')
+        self.add_file('/2/new', 'new content')
+        self.add_file('/2/link', 'other content', os.lstat('/1/other').st_ino)
+        self.index = ContentIndex()
+        self.index.merge(INodeFileList('/1'))
+
+    def test_register(self):
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(len(self.index.sizes[7]), 1)
+
+    def test_merge(self):
+        snapshot = INodeFileList('/2')
+        merged = self.index.merge(snapshot)
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(merged.value_for_index(0).merged_into.files, set(['/2/file']))
+        self.assertEqual(os.lstat('/2/file').st_ino, os.lstat('/1/file').st_ino)
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.inode_files[os.lstat('/1/other').st_ino].files, set(['/2/link']))
+        for canonical in self.index.inode_files:
+            self.assertEqual(len(canonical), 1)
+
+    def test_stale_canonical(self):
+        canonical = self.index.inode_files[os.lstat('/1/file').st_ino]
+        canonical.prefix_md5sum
+        canonical.sha1sum
+        filesystem.RemoveObject('/1/file')
+        self._files.remove('/1/file')
+
+        merged = self.index.merge(INodeFileList('/2'))
+        self.assertEqual(len(merged), 0)
+        self.assertTrue(os.path.exists('/2/file'))
+        self.assertFalse(os.path.exists('/2/file.file_merge-bu'))
+        self.assertNotIn(canonical, self.index)
+        self.assertIn(INodeFile('/2/file'), self.index)
+
+    def test_unreadable_file(self):
+        self.add_file('/2/unreadable', 'content')
+        snapshot = INodeFileList('/2')
+        unreadable = snapshot[os.lstat('/2/unreadable').st_ino]
+
+        def hash(*args, **kwargs):
+            raise OSError("Permission denied")
+        unreadable.hash = hash
+        merged = self.index.merge(snapshot)
+        self.assertEqual(len(merged), 1)
+        self.assertIn(unreadable, snapshot)
+        self.assertNotIn(unreadable, self.index)
+        self.assertNotEqual(os.lstat('/2/unreadable').st_ino, os.lstat('/1/file').st_ino)
+
+    def test_merge_unique_size_is_not_hashed(self):
+        self.index.merge(INodeFileList('/2'))
+        new = self.index.inode_files[os.lstat('/2/new').st_ino]
+        self.assertIsNone(getattr(new, '_sha1sum', None))
+
+    def test_demo(self):
+        merged = self.index.merge(INodeFileList('/2'), demo=True)
+        self.assertEqual(len(merged), 1)
+        self.assertNotEqual(os.lstat('/2/file').st_ino, os.lstat('/1/file').st_ino)
+
+    def test_dump_and_load(self):
+        self.add_file('/index', '')
+        self.index.dump('/index')
+        index = ContentIndex('/index')
+        self.assertEqual(index.inode_files.storage, self.index.inode_files.storage)
+        self.assertEqual(sorted(index.sizes), [7, 13])
+
+
+class TestEstimateSavings(TestCase):
+    def setUp(self):
+        for i in range(10):
+            self.add_file('/e/same%d' % i, 10 * 'same')
+        for i in range(10):
+            self.add_file('/e/different%d' % i, 'different%d' % i)
+        self.add_file('/e/unique', 'unique')
+        self.ilist = INodeFileList('/e')
+
+    def test_estimate(self):
+        estimate = estimate_savings(self.ilist)
+        self.assertEqual(estimate.estimate, 360)
+        self.assertEqual(estimate.upper_bound, 360 + 90)
+        self.assertEqual((estimate.low, estimate.high), (360, 360))
+        self.assertEqual(estimate.groups, 2)
+
+    def test_sampled_estimate(self):
+        estimate = estimate_savings(self.ilist, sample_size=1, seed=1)
+        self.assertEqual(estimate.sampled, 1)
+        self.assertIn(estimate.estimate, (0, 450))
+        self.assertEqual((estimate.low, estimate.high), (0, 450))
+
+    def test_merge_demo(self):
+        merged = self.ilist.merge(demo=True)
+        self.assertEqual(len(merged), 9)
+        self.assertEqual(len(self.ilist), 21)
+        self.assertEqual(len(set(os.lstat('/e/same%d' % i).st_ino for i in range(10))), 10)
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        self.add_file('/p/file1', 'content')
+        self.add_file('/p/file2', 'content')
+
+    def test_profile(self):
+        add = INodeFileList.add
+        with Profiler() as profiler:
+            self.assertNotEqual(INodeFileList.add, add)
+            INodeFileList('/p').merge(small_file_limit=0)
+        self.assertEqual(INodeFileList.add, add)
+        self.assertIs(file_merge.inode.os, os)
+        self.assertIs(file_merge.inode.open, open)
+
+        phases = profiler.phases
+        self.assertEqual(sorted(phases), ['INodeFile.hash', 'INodeFileList.add', 'INodeFileList.iter_list'])
+        self.assertEqual(phases['INodeFile.hash'].calls, 6)
+        self.assertEqual(phases['INodeFile.hash'].bytes_read, 42)
+        self.assertEqual(phases['INodeFileList.add'].bytes_read, 0)
+        self.assertGreater(phases['INodeFileList.add'].os_calls, 0)
+        self.assertEqual(len(profiler.report().split('\n')), 3)
+
+    def test_profile_small_files(self):
+        with Profiler() as profiler:
+            INodeFileList('/p').merge()
+        self.assertEqual(profiler.phases['INodeFile.read_hashes'].calls, 2)
+        self.assertEqual(profiler.phases['INodeFile.read_hashes'].bytes_read, 14)
+
+    def test_dump_stats_without_cprofile(self):
+        self.assertRaises(ValueError, Profiler().dump_stats, '/p/stats')
+
+    def test_counting_os(self):
+        profiler = Profiler()
+        counting_os = file_merge.profiling.CountingOS(os, profiler)
+        self.assertIs(counting_os.lstat, counting_os.lstat)
+        counting_os.lstat('/p/file1')
+        self.assertEqual(profiler.os_calls, 1)
+        self.assertEqual(counting_os.sep, os.sep)
+
+
+@unittest.skipIf(pipeline is None, "needs Python 3.7")
+class TestPipeline(TestCase):
+    def setUp(self):
+        self.add_file('/q/file1', 'content', 20)
+        self.add_file('/q/sub/file2', 'content', 21)
+        self.add_file('/q/sub/file3', 'content', 22)
+        self.add_file('/q/sub/link', 'content', 22)
+        self.add_file('/q/other', 'contenu', 23)
+        self.add_file('/q/unique', 'unique content', 24)
+        self.add_file('/q/empty1', '', 25)
+        self.add_file('/q/empty2', '', 26)
+
+    def test_run(self):
+        pipeline = Pipeline('/q', queue_size=2, hashers=2)
+        merged = pipeline.run()
+        self.assertEqual(len(merged), 2)
+        inodes = set(os.lstat(path).st_ino for path in ['/q/file1', '/q/sub/file2', '/q/sub/file3', '/q/sub/link'])
+        self.assertEqual(len(inodes), 1)
+        self.assertEqual(os.lstat('/q/other').st_ino, 23)
+        self.assertEqual(len(pipeline.inode_files), 5)
+        self.assertIsNone(getattr(pipeline.inode_files[24], '_prefix_md5sum', None))
+
+    def test_demo(self):
+        merged = Pipeline('/q', demo=True).run()
+        self.assertEqual(len(merged), 2)
+        self.assertEqual(os.lstat('/q/file1').st_ino, 20)
+        self.assertEqual(os.lstat('/q/sub/file2').st_ino, 21)
+
+    def test_hardlinks_outside(self):
+        # Inode 22 has a further hardlink outside of /q.
+        for path in ['/q/sub/file3', '/q/sub/link']:
+            filesystem.GetObject(path).st_nlink = 3
+        pipeline = Pipeline('/q', queue_size=2, hashers=2)
+        merged = pipeline.run()
+        self.assertEqual(sorted(item.inode for item in merged), [20, 21])
+        for path in ['/q/file1', '/q/sub/file2', '/q/sub/file3', '/q/sub/link']:
+            self.assertEqual(os.lstat(path).st_ino, 22)
+
+    def run_stage(self, pipeline, stage, source, items, late=None):
+        """
+        Runs one stage with 'items' in the queue 'source'. 'late' is called,
+        after the items were taken and before the queue is closed.
+        """
+        async def run():
+            setattr(pipeline, source, asyncio.Queue())
+            for queue in ['prefix_queue', 'links']:
+                setattr(pipeline, queue, asyncio.Queue())
+            task = asyncio.ensure_future(stage())
+            for item in items:
+                await getattr(pipeline, source).put(item)
+            while not getattr(pipeline, source).empty():
+                await asyncio.sleep(0)
+            if late is not None:
+                late()
+            await pipeline.close(getattr(pipeline, source), pipeline.hashers)
+            await task
+            links = []
+            while not pipeline.links.empty():
+                links.append(pipeline.links.get_nowait())
+            return [link for link in links if link is not None]
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(run())
+        finally:
+            loop.close()
+
+    def test_plan_waits_for_walk(self):
+        pipeline = Pipeline('/q', hashers=1)
+        target = INodeFile('/q/file1')
+        item = INodeFile('/q/sub/file3')
+        item._nlink = 2
+        links = self.run_stage(pipeline, pipeline.plan, 'confirmed', [target, item],
+                               late=lambda: item.addfile(INodeFile('/q/sub/link')))
+        self.assertEqual(links, [(target, item)])
+
+    def test_plan_incomplete_target(self):
+        pipeline = Pipeline('/q', hashers=1)
+        target = INodeFile('/q/file1')
+        item = INodeFile('/q/sub/file3')
+        item._nlink = 2
+        links = self.run_stage(pipeline, pipeline.plan, 'confirmed', [target, item])
+        self.assertEqual(links, [(item, target)])
+
+    def test_hardlink_to_scheduled_item(self):
+        pipeline = Pipeline('/q', hashers=1)
+        target = INodeFile('/q/file1')
+        pipeline.scheduled[22] = target
+        link = INodeFile('/q/sub/link')
+        links = self.run_stage(pipeline, pipeline.group, 'files', [INodeFile('/q/sub/file3'), link])
+        self.assertEqual(links, [(target, link)])
+        self.assertEqual(pipeline.inode_files[22].files, set(['/q/sub/file3']))
+
+
+class TestDirectoryTree(TestCase):
+    def setUp(self):
+        for snapshot in ['/d/1', '/d/2', '/d/3']:
+            self.add_file(snapshot + '/same/file', 'content')
+            self.add_file(snapshot + '/same/sub/file', 'other content')
+        self.add_file('/d/3/same/new', 'new content')
+        self.add_file('/d/1/unique', 'unique')
+        self.add_file('/d/2/unique', 'unique')
+        self.add_file('/d/3/unique', 'euqinu')
+
+    def test_shapes(self):
+        tree = DirectoryTree('/d')
+        self.assertEqual(tree.shapes['/d/1/same'], tree.shapes['/d/2/same'])
+        self.assertNotEqual(tree.shapes['/d/1/same'], tree.shapes['/d/3/same'])
+        self.assertEqual(tree.shapes['/d/1'], tree.shapes['/d/2'])
+        self.assertEqual(tree.file_counts['/d'], 10)
+
+    def test_duplicates(self):
+        tree = DirectoryTree('/d')
+        self.assertEqual(tree.duplicates(), [['/d/1', '/d/2'], ['/d/1/same/sub', '/d/2/same/sub', '/d/3/same/sub']])
+        self.assertIsNone(getattr(tree.entries['/d/3'][0]['unique'], '_sha1sum', None))
+
+    def test_merge(self):
+        tree = DirectoryTree('/d')
+        merged = tree.merge()
+        self.assertEqual(len(merged), 4)
+        self.assertEqual(os.lstat('/d/1/unique').st_ino, os.lstat('/d/2/unique').st_ino)
+        self.assertEqual(os.lstat('/d/1/same/sub/file').st_ino, os.lstat('/d/3/same/sub/file').st_ino)
+        self.assertNotEqual(os.lstat('/d/1/same/file').st_ino, os.lstat('/d/3/same/file').st_ino)
+        self.assertEqual(len(tree.inode_files), 6)
+
+    def test_merge_demo(self):
+        merged = DirectoryTree('/d').merge(demo=True)
+        self.assertEqual(len(merged), 4)
+        self.assertNotEqual(os.lstat('/d/1/unique').st_ino, os.lstat('/d/2/unique').st_ino)
+
+
+class TestSpillScanner(TestCase):
+    def setUp(self):
+        self.add_file('/spill/a1', 'aaaa', 40)
+        self.add_file('/spill/a2', 'aaaa', 41)
+        self.add_file('/spill/link', 'aaaa', 41)
+        self.add_file('/spill/unique', 'unique', 42)
+        self.add_file('/spill/hardlinked1', 'hardlinked', 43)
+        self.add_file('/spill/hardlinked2', 'hardlinked', 43)
+        self.add_file('/spill/sub/b', 'bbbb', 44)
+
+    def test_candidates(self):
+        scanner = SpillScanner('/spill', memory_budget=2 * file_merge.spill.RECORD_SIZE)
+        candidates = scanner.candidates()
+        self.assertEqual(sorted(item.inode for item in candidates), [40, 41, 44])
+        self.assertEqual(candidates[41].files, set(['/spill/a2', '/spill/link']))
+        self.assertEqual(scanner.runs, [])
+        self.assertEqual(len(candidates.merge()), 1)
+        self.assertEqual(os.lstat('/spill/sub/b').st_ino, 44)
+
+    def test_spill(self):
+        scanner = SpillScanner('/spill', memory_budget=3 * file_merge.spill.RECORD_SIZE)
+        scanner.scan()
+        self.assertEqual(len(scanner.runs), 2)
+        self.assertEqual(len(scanner.buffer), 1)
+        self.assertEqual([record[0] for record in scanner.records()], [4, 4, 4, 4, 6, 10, 10])
+        scanner.cleanup()
+        self.assertEqual(scanner.runs, [])
+
+    def test_other_device(self):
+        self.add_file('/spill/mnt/a', 'aaaa', 40)
+        filesystem.GetObject('/spill').st_dev = 1
+        self.addCleanup(setattr, filesystem.GetObject('/spill'), 'st_dev', None)
+        for path in self._files:
+            filesystem.GetObject(path).st_dev = 2 if path.startswith('/spill/mnt/') else 1
+        candidates = SpillScanner('/spill').candidates()
+        self.assertEqual(sorted(item.inode for item in candidates), [40, 41, 44])
+        self.assertEqual(candidates[40].files, set(['/spill/a1']))
+
+    def test_dump(self):
+        self.add_file('/spill/files', 'old dump')
+        self.add_file('/spill/new\nline', 'newline')
+        scanner = SpillScanner('/spill', memory_budget=2 * file_merge.spill.RECORD_SIZE)
+        self.assertEqual(scanner.dump('/spill/files'), 5)
+        self.assertEqual(scanner.runs, [])
+        inode_file_list = INodeFileList(load='/spill/files')
+        self.assertEqual(sorted(item.inode for item in inode_file_list), [40, 41, 42, 43, 44])
+        self.assertEqual(inode_file_list[43].files, set(['/spill/hardlinked1', '/spill/hardlinked2']))
+        self.assertEqual(inode_file_list[44].size, 4)
+
+    def test_spill_any_path(self):
+        records = [(1, 1, 'new\nline'), (2, 2, 'latin\udce9'), (3, 3, 'null')]
+        scanner = SpillScanner('/spill')
+        scanner.buffer = list(records)
+        scanner.spill()
+        self.assertEqual(list(scanner.read_run(scanner.runs[0])), records)
+        scanner.cleanup()
+
+    def test_cleanup_on_error(self):
+        scanner = SpillScanner('/spill', memory_budget=file_merge.spill.RECORD_SIZE)
+        runs = []
+
+        def spill():
+            SpillScanner.spill(scanner)
+            runs.extend(scanner.runs)
+            raise OSError("disk full")
+        scanner.spill = spill
+        self.assertRaises(OSError, scanner.candidates)
+        self.assertTrue(all(run.closed for run in runs))
+        self.assertEqual(scanner.runs, [])
+
+
+class TestDirectoryCache(TestCase):
+    def setUp(self):
+        self.add_file('/c/file', 'content', 50)
+        self.add_file('/c/sub/file', 'content', 51)
+        self.add_file('/c/sub/link', 'content', 51)
+        self.cache = DirectoryCache()
+        self.ilist = INodeFileList('/c', cache=self.cache)
+
+    def test_walk(self):
+        self.assertEqual(len(self.ilist), 2)
+        self.assertEqual(self.ilist[51].files, set(['/c/sub/file', '/c/sub/link']))
+        self.assertEqual((self.cache.listed, self.cache.reused), (2, 0))
+
+    def test_rescan(self):
+        self.add_file('/c/sub/new', 'new')
+        ilist = INodeFileList('/c', cache=self.cache)
+        self.assertEqual((self.cache.listed, self.cache.reused), (2, 2))
+        self.assertEqual(len(ilist), 2)
+
+        os.utime('/c/sub', (1, 1))
+        ilist = INodeFileList('/c', cache=self.cache)
+        self.assertEqual((self.cache.listed, self.cache.reused), (3, 3))
+        self.assertEqual(len(ilist), 3)
+
+    def test_removed_directory(self):
+        self.cache.directories['/c/gone'] = (0, 0, [], [])
+        self.cache.directories['/cc'] = (0, 0, [], [])
+        list(self.cache.walk('/c'))
+        self.assertEqual(sorted(self.cache.directories), ['/c', '/c/sub', '/cc'])
+
+    def test_dump_and_load(self):
+        self.add_file('/dircache', '')
+        self.cache.dump('/dircache')
+        cache = DirectoryCache('/dircache')
+        self.assertEqual(cache.directories, self.cache.directories)
+        self.assertEqual(len(INodeFileList('/c', cache=cache)), 2)
+        self.assertEqual((cache.listed, cache.reused), (0, 2))
+
+
+class TestMergeScheduler(TestCase):
+    def setUp(self):
+        self.add_file('/s/big1', 100 * 'b')
+        self.add_file('/s/big2', 100 * 'b')
+        self.add_file('/s/small1', 'small')
+        self.add_file('/s/small2', 'small')
+        self.add_file('/s/small3', 'small')
+
+    def tearDown(self):
+        super(TestMergeScheduler, self).tearDown()
+        if os.path.exists('/state'):
+            os.remove('/state')
+
+    def test_candidates(self):
+        scheduler = MergeScheduler(INodeFileList('/s'))
+        sizes = [size_list.value_for_index(0).size for size_list in scheduler.candidates()]
+        self.assertEqual(sizes, [5, 100])
+
+    def test_run(self):
+        scheduler = MergeScheduler(INodeFileList('/s'), state='/state')
+        merged = scheduler.run()
+        self.assertEqual(len(merged), 3)
+        self.assertTrue(scheduler.finished)
+        self.assertFalse(os.path.exists('/state'))
+
+    def test_io_budget(self):
+        scheduler = MergeScheduler(INodeFileList('/s'), io_budget=100, state='/state')
+        merged = scheduler.run()
+        self.assertEqual(len(merged), 2)
+        self.assertFalse(scheduler.finished)
+        with open('/state') as f:
+            self.assertEqual(f.read(), '5\n')
+
+        scheduler = MergeScheduler(INodeFileList('/s'), state='/state')
+        self.assertEqual(scheduler.done, set([5]))
+        self.assertEqual(len(scheduler.candidates()), 1)
+        self.assertEqual(len(scheduler.run()), 1)
+
+    def test_io_budget_skips_groups(self):
+        for i in range(3):
+            self.add_file('/s/mid60-%d' % i, 60 * 'm')
+            self.add_file('/s/mid50-%d' % i, 50 * 'n')
+        scheduler = MergeScheduler(INodeFileList('/s'), io_budget=200)
+        self.assertEqual([size_list.value_for_index(0).size for size_list in scheduler.candidates()], [60, 50, 5, 100])
+        scheduler.run()
+        self.assertEqual(scheduler.done, set([60, 5]))
+        self.assertFalse(scheduler.finished)
+
+    def test_group_bigger_then_io_budget(self):
+        # Each group costs more then the whole budget, so each run merges one.
+        scheduler = MergeScheduler(INodeFileList('/s'), io_budget=10, state='/state')
+        self.assertEqual(len(scheduler.run()), 2)
+        self.assertFalse(scheduler.finished)
+
+        scheduler = MergeScheduler(INodeFileList('/s'), io_budget=10, state='/state')
+        self.assertEqual(len(scheduler.run()), 1)
+        self.assertTrue(scheduler.finished)
+        self.assertEqual(os.lstat('/s/big1').st_ino, os.lstat('/s/big2').st_ino)
+
+    def test_progress_is_saved_after_each_group(self):
+        scheduler = MergeScheduler(INodeFileList('/s'), state='/state')
+        groups = scheduler.candidates()
+
+        def interrupt(*args):
+            raise KeyboardInterrupt
+        groups[1].merge_size_list = interrupt
+        scheduler.candidates = lambda: groups
+        self.assertRaises(KeyboardInterrupt, scheduler.run)
+        with open('/state') as f:
+            self.assertEqual(f.read(), '5\n')
+
+    def test_time_budget(self):
+        scheduler = MergeScheduler(INodeFileList('/s'), time_budget=0)
+        self.assertEqual(len(scheduler.run()), 0)
+        self.assertFalse(scheduler.finished)
+
+
+class StubPool(object):
+    """
+    Replaces multiprocessing and queue in file_merge.programs.
+
+    A task runs, when a result is taken from the queue. The devices of the
+    tasks, that were started but not finished, are saved for each start.
+    """
+    def __init__(self):
+        self.tasks = collections.deque()
+        self.results = collections.deque()
+        self.running = []
+
+    def Pool(self, processes):
+        return self
+
+    def Queue(self):
+        return self
+
+    def apply_async(self, function, args, callback, error_callback):
+        self.tasks.append((function, args, callback, error_callback))
+        self.running.append(sorted(os.stat(task[1][0]).st_dev for task in self.tasks))
+
+    def put(self, item):
+        self.results.append(item)
+
+    def get(self):
+        while not self.results:
+            function, args, callback, error_callback = self.tasks.popleft()
+            try:
+                result = function(*args)
+            except Exception as error:
+                error_callback(error)
+            else:
+                callback(result)
+        return self.results.popleft()
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+class TestScanSnapshotsParallel(TestCase):
+    def setUp(self):
+        for snapshot, device in [(1, 1), (2, 1), (3, 1), (4, 2), (5, 2)]:
+            self.add_file('/snap/%d/file' % snapshot, 'content %d' % snapshot)
+            filesystem.GetObject('/snap/%d' % snapshot).st_dev = device
+            filesystem.GetObject('/snap/%d/file' % snapshot).st_dev = device
+        self.pool = StubPool()
+        self.messages = []
+        self.scan_snapshot = file_merge.programs.scan_snapshot
+        file_merge.programs.multiprocessing = self.pool
+        file_merge.programs.queue = self.pool
+        file_merge.programs.verbose = lambda message, level=None: self.messages.append(message)
+
+    def tearDown(self):
+        file_merge.programs.multiprocessing = multiprocessing
+        file_merge.programs.queue = queue
+        file_merge.programs.verbose = file_merge.utils.verbose
+        file_merge.programs.scan_snapshot = self.scan_snapshot
+        filesystem.RemoveObject('/snap')
+
+    def test_walks_per_device(self):
+        file_merge.programs.p3('/snap', processes=4, walks_per_device=1)
+        self.assertEqual(max(len(running) for running in self.pool.running), 2)
+        for running in self.pool.running:
+            self.assertEqual(len(running), len(set(running)))
+        for snapshot in range(1, 6):
+            self.assertTrue(os.path.exists('/snap/%d/files' % snapshot))
+        self.assertEqual(self.messages[-1], "5/5 snapshots, 5 files: /snap/3")
+
+    def test_two_walks_per_device(self):
+        file_merge.programs.p3('/snap', processes=4, walks_per_device=2)
+        self.assertEqual(self.pool.running[3], [1, 1, 2, 2])
+
+    def test_memory_budget(self):
+        file_merge.programs.p3('/snap', processes=4, memory_budget=file_merge.spill.RECORD_SIZE)
+        for snapshot in range(1, 6):
+            inode_file_list = INodeFileList(load='/snap/%d/files' % snapshot)
+            self.assertEqual([item.files for item in inode_file_list], [set(['/snap/%d/file' % snapshot])])
+        self.assertEqual(self.messages[-1], "5/5 snapshots, 5 files: /snap/3")
+
+    def test_p6(self):
+        self.add_file('/snap/1/copy', 'content 1')
+        self.add_file('/snap/other/copy', 'content 1')
+        filesystem.GetObject('/snap/1/copy').st_dev = 1
+        file_merge.programs.p6('/snap')
+        self.assertEqual(os.lstat('/snap/1/file').st_ino, os.lstat('/snap/1/copy').st_ino)
+        self.assertNotEqual(os.lstat('/snap/1/file').st_ino, os.lstat('/snap/other/copy').st_ino)
+        self.assertFalse(os.path.exists('/snap/other/files'))
+        inode_file_list = INodeFileList(load='/snap/1/files')
+        self.assertEqual([item.files for item in inode_file_list], [set(['/snap/1/file', '/snap/1/copy'])])
+
+    def test_failing_snapshot(self):
+        def scan_snapshot(full_path, cache_path=None, memory_budget=None):
+            if full_path == '/snap/2':
+                raise OSError("Permission denied")
+            return self.scan_snapshot(full_path, cache_path, memory_budget)
+        file_merge.programs.scan_snapshot = scan_snapshot
+        file_merge.programs.p3('/snap', processes=4)
+        self.assertIn("Can not scan /snap/2: Permission denied", self.messages)
+        self.assertFalse(os.path.exists('/snap/2/files'))
+        for snapshot in [1, 3, 4, 5]:
+            self.assertTrue(os.path.exists('/snap/%d/files' % snapshot))
+        self.assertEqual(self.messages[-1], "5/5 snapshots, 4 files: /snap/3")
+
+
 if __name__ == '__main__':
     unittest.main()